@@ -0,0 +1,483 @@
+"""Benchmarks for the render, export, bulk and scan hot paths.
+
+Runs headless (no Tk) on synthetic payloads. Each benchmark reports
+operations per second and how far one operation raises resident memory
+(RSS), including PIL buffers, plus the peak RSS of any worker
+processes it starts. --compare fails on slowdowns and on memory growth.
+
+    python qr_bench.py                      # run and print results
+    python qr_bench.py --save bench.json    # store a baseline
+    python qr_bench.py --compare bench.json # fail if slower or bigger than baseline
+
+Render benchmarks clear the matrix cache before every operation so they
+measure a cold encode, which is what typing a new character costs.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from itertools import count
+from io import BytesIO
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import qr_bulk
+import qr_export
+import qr_history
+import qr_render
+import qr_scan
+
+
+# Payload lengths in characters
+PAYLOAD_SIZES = {"short": 24, "medium": 250, "long": 1200}
+
+# Entries in the synthetic history database
+HISTORY_ROWS = 50000
+
+# Memory growth below this is noise, never a regression
+MEMORY_NOISE_KIB = 1024
+
+# ops_per_call lets batch benchmarks report rows/s instead of batches/s
+Benchmark = namedtuple("Benchmark", ["name", "func", "ops_per_call"])
+
+
+def make_payload(length, seed=0):
+    """Deterministic URL-like payload of the given length"""
+    rng = random.Random(seed)
+    prefix = "https://example.com/"
+    alphabet = string.ascii_letters + string.digits + "-_/"
+    return prefix + "".join(rng.choice(alphabet)
+                            for _ in range(max(0, length - len(prefix))))
+
+
+def make_logo(directory):
+    """Write a small RGBA logo and return its path"""
+    path = os.path.join(directory, "bench_logo.png")
+    logo = Image.new("RGBA", (256, 256), (220, 40, 40, 255))
+    logo.save(path)
+    return path
+
+
+def cold(func):
+    """Wrap func so every call starts with an empty matrix cache"""
+    def run():
+        qr_render.MATRIX_CACHE.clear()
+        return func()
+    return run
+
+
+def build_benchmarks(workdir, bulk_rows=200):
+    """Return the list of benchmarks, using workdir for scratch files"""
+    benchmarks = []
+    logo_path = make_logo(workdir)
+    gradient = dict(use_gradient=True, gradient_start="#1a73e8",
+                    gradient_end="#e91e63")
+
+    for size_name, length in PAYLOAD_SIZES.items():
+        data = make_payload(length)
+        for ec in ("L", "H"):
+            base = qr_render.QRStyle(
+                error_correction=qr_render.error_correction_from_label(ec))
+            tag = f"{size_name}-{ec}"
+
+            benchmarks.append(Benchmark(
+                f"plan/{tag}",
+                lambda d=data, e=base.error_correction:
+                    qr_render.plan_encoding(d, e), 1))
+            benchmarks.append(Benchmark(
+                f"encode/{tag}",
+                lambda d=data, e=base.error_correction:
+                    qr_render.encode(d, e), 1))
+            benchmarks.append(Benchmark(
+                f"encode-pinned-mask/{tag}",
+                lambda d=data, e=base.error_correction:
+                    qr_render.encode(d, e, mask_pattern=0), 1))
+            benchmarks.append(Benchmark(
+                f"preview/{tag}",
+                cold(lambda d=data, s=base.with_options(box_size=8, border=2):
+                     qr_render.render_preview(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"render/{tag}",
+                cold(lambda d=data, s=base: qr_render.render_image(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"render-gradient/{tag}",
+                cold(lambda d=data, s=base.with_options(**gradient):
+                     qr_render.render_image(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"render-shaped/{tag}",
+                cold(lambda d=data, s=base.with_options(module_shape="dots",
+                                                         eye_pattern="circle"):
+                     qr_render.render_image(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"render-logo/{tag}",
+                cold(lambda d=data, s=base.with_options(logo_path=logo_path):
+                     qr_render.render_image(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"high-res/{tag}",
+                cold(lambda d=data, s=base.with_options(box_size=20, border=8):
+                     qr_render.render_png(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"svg/{tag}",
+                cold(lambda d=data, s=base: qr_export.render_svg(d, s)), 1))
+            benchmarks.append(Benchmark(
+                f"pdf/{tag}",
+                cold(lambda d=data, s=base: qr_export.render_pdf(d, s)), 1))
+
+        # Encoding alone, per compression preset, of a high-res shaped code
+        # (anti-aliased edges, saved as a palette)
+        image = qr_render.render_image(data, qr_render.QRStyle(
+            box_size=20, border=8, module_shape="dots"))
+        for preset in qr_render.PNG_PRESETS:
+            benchmarks.append(Benchmark(
+                f"png-{preset}/{size_name}",
+                lambda i=image, p=preset: qr_render.image_to_png_bytes(i, p), 1))
+
+        # Decoding a rendered PNG, as scan_from_image does
+        png = np.frombuffer(qr_render.render_png(data), dtype=np.uint8)
+        benchmarks.append(Benchmark(
+            f"scan/{size_name}",
+            lambda p=png: qr_scan.decode_frame(
+                cv2.imdecode(p, cv2.IMREAD_COLOR), max_side=None), 1))
+
+        # One 720p camera frame through the scanner's downscaled detect path.
+        # Long payloads are too dense to read from a frame this size.
+        if size_name == "long":
+            continue
+        frame = np.full((720, 1280, 3), 200, dtype=np.uint8)
+        code = cv2.resize(cv2.imdecode(png, cv2.IMREAD_COLOR), (700, 700),
+                          interpolation=cv2.INTER_AREA)
+        frame[10:710, 290:990] = code
+        benchmarks.append(Benchmark(
+            f"scan-frame/{size_name}",
+            lambda f=frame: qr_scan.decode_frame(f), 1))
+
+    # A 720p frame of a 4x2 label sheet, decoded from scratch and tracked
+    sheet = np.full((720, 1280), 230, dtype=np.uint8)
+    for i in range(8):
+        code = np.asarray(qr_render.render_image(
+            f"ITEM-{i:04d}", qr_render.QRStyle(box_size=6)).convert("L"))
+        top, left = 20 + (i // 4) * 340, 20 + (i % 4) * 310
+        sheet[top:top + code.shape[0], left:left + code.shape[1]] = code
+    tracker = qr_scan.CodeTracker(max_side=None)
+    benchmarks.append(Benchmark(
+        "scan-sheet/cold",
+        lambda: qr_scan.CodeTracker(max_side=None).update(sheet), 8))
+    benchmarks.append(Benchmark(
+        "scan-sheet/tracked", lambda: tracker.update(sheet), 8))
+
+    # History with a long past: one insert, the first page, a deep page
+    # and the search box as it is typed into and narrowed
+    history = qr_history.HistoryStore(os.path.join(workdir, "history.db"))
+    history.add_many({"timestamp": f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} "
+                                   f"{i % 24:02d}:{i % 60:02d}:00",
+                      "type": ("URL", "Text", "Email", "WiFi")[i % 4],
+                      "data": make_payload(60, seed=i)}
+                     for i in range(HISTORY_ROWS))
+    deep = history.page(limit=HISTORY_ROWS // 2)[-1]
+    benchmarks.append(Benchmark(
+        "history/add", lambda: history.add("https://example.com/", "", "URL"), 1))
+    benchmarks.append(Benchmark("history/page", lambda: history.page(), 1))
+    benchmarks.append(Benchmark(
+        "history/page-deep", lambda: history.page(before=deep), 1))
+    benchmarks.append(Benchmark(
+        "history/search",
+        lambda: (history.count(query="e", limit=qr_history.COUNT_LIMIT),
+                 history.page(query="e")), 1))
+    benchmarks.append(Benchmark(
+        "history/search-filtered",
+        lambda: (history.count(query="example", entry_type="Text",
+                               since="2024-06-01", until="2024-06-30",
+                               limit=qr_history.COUNT_LIMIT),
+                 history.page(query="example", entry_type="Text",
+                              since="2024-06-01", until="2024-06-30")), 1))
+
+    # Thumbnails: a row seen before (read from disk) and a new one
+    thumbnails = qr_history.ThumbnailCache(os.path.join(workdir, "thumbnails"))
+    thumbnail_seen = make_payload(60, seed=0)
+    thumbnails.get(thumbnail_seen)
+    new_thumbnails = (make_payload(60, seed=i) for i in count(1))
+    benchmarks.append(Benchmark(
+        "history/thumbnail-cached", lambda: thumbnails.get(thumbnail_seen), 1))
+    benchmarks.append(Benchmark(
+        "history/thumbnail-new",
+        lambda: thumbnails.get(next(new_thumbnails)), 1))
+
+    rows = [{"url": make_payload(PAYLOAD_SIZES["medium"], seed=i),
+             "name": f"row{i}"} for i in range(bulk_rows)]
+
+    def bulk(workers, rows=rows, **options):
+        def run():
+            output_dir = tempfile.mkdtemp(dir=workdir)
+            try:
+                qr_bulk.generate_bulk(rows, output_dir, workers=workers,
+                                      **options)
+            finally:
+                shutil.rmtree(output_dir)
+        return cold(run)
+
+    def label_sheet():
+        qr_bulk.generate_label_sheet(rows, BytesIO())
+
+    benchmarks.append(Benchmark(f"labels-{bulk_rows}",
+                                cold(label_sheet), bulk_rows))
+    benchmarks.append(Benchmark(f"bulk-{bulk_rows}/serial",
+                                bulk(1), bulk_rows))
+    benchmarks.append(Benchmark(f"bulk-{bulk_rows}/pool",
+                                bulk(None), bulk_rows))
+    benchmarks.append(Benchmark(f"bulk-{bulk_rows}/zip-only",
+                                bulk(None, write_files=False), bulk_rows))
+    benchmarks.append(Benchmark(
+        f"bulk-{bulk_rows}/repeated",
+        bulk(None, rows=[dict(row, url=rows[i % 10]["url"])
+                         for i, row in enumerate(rows)]), bulk_rows))
+    benchmarks.append(Benchmark(f"bulk-{bulk_rows}/svg",
+                                bulk(None, output_format="svg"), bulk_rows))
+    benchmarks.append(Benchmark(
+        f"bulk-{bulk_rows}/shaped",
+        bulk(None, style=qr_bulk.DEFAULT_BULK_STYLE.with_options(
+            module_shape="rounded", eye_pattern="rounded")), bulk_rows))
+
+    # Scanning a finished bulk archive back against its rows
+    verify_dir = tempfile.mkdtemp(dir=workdir)
+    qr_bulk.generate_bulk(rows, verify_dir, write_files=False)
+    verify_zip = os.path.join(verify_dir, "qr_codes.zip")
+    benchmarks.append(Benchmark(
+        f"verify-{bulk_rows}",
+        lambda: qr_scan.verify_bulk(verify_zip, rows), bulk_rows))
+    return benchmarks
+
+
+def _proc_status(pid, field):
+    """A /proc/<pid>/status field such as VmHWM in KiB, or None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _descendants(pid):
+    """Pids of every live process below pid, e.g. pool workers under a forkserver"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The name field may contain spaces; ppid is the 2nd field after it
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    found, stack = set(), [pid]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            found.add(child)
+            stack.append(child)
+    return found
+
+
+class PeakRSS:
+    """Peak resident memory of a block of code, in KiB.
+
+    self_kib is how far this process's RSS rose above where it started.
+    On Linux the high-water mark is reset through /proc/self/clear_refs,
+    so it is exact. Elsewhere it falls back to ru_maxrss, which only shows
+    growth past the highest point reached so far. workers_kib sums the
+    peak RSS (VmHWM) of every process started below this one during the
+    block, found by polling /proc; it is None where /proc isn't
+    available.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.self_kib = 0.0
+        self.workers_kib = None
+        self._proc = os.path.exists("/proc/self/status")
+        self._stop = threading.Event()
+        self._workers = {}
+
+    def _reset_high_water_mark(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+    def _poll(self):
+        while True:
+            for pid in _descendants(os.getpid()) - self._existing:
+                peak = _proc_status(pid, "VmHWM")
+                if peak is not None:
+                    self._workers[pid] = max(peak, self._workers.get(pid, 0))
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if self._proc and self._reset_high_water_mark():
+            self._start = _proc_status("self", "VmRSS")
+        else:
+            self._proc = False
+            self._start = self._ru_maxrss()
+        if os.path.isdir("/proc"):
+            self._existing = _descendants(os.getpid())
+            self._poller = threading.Thread(target=self._poll, daemon=True)
+            self._poller.start()
+        return self
+
+    def __exit__(self, *exc):
+        if os.path.isdir("/proc"):
+            self._stop.set()
+            self._poller.join()
+            self.workers_kib = float(sum(self._workers.values()))
+        if self._proc:
+            peak = _proc_status("self", "VmHWM")
+        else:
+            peak = self._ru_maxrss()
+        if peak is not None and self._start is not None:
+            self.self_kib = float(max(0, peak - self._start))
+
+    @staticmethod
+    def _ru_maxrss():
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KiB elsewhere
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def measure(func, ops_per_call=1, min_time=1.0, min_runs=3):
+    """Return (ops per second, peak RSS growth in KiB, worker peak RSS in KiB)"""
+    func()  # warm up imports, pools and caches that aren't under test
+
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while runs < min_runs or elapsed < min_time:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - start
+
+    with PeakRSS() as peak:
+        func()
+
+    return runs * ops_per_call / elapsed, peak.self_kib, peak.workers_kib
+
+
+def run_benchmarks(benchmarks, name_filter=None, min_time=1.0, stream=sys.stdout):
+    """Run benchmarks and return {name: {"ops_per_sec", "peak_rss_kib", "worker_rss_kib"}}"""
+    results = {}
+    for bench in benchmarks:
+        if name_filter and name_filter not in bench.name:
+            continue
+        ops, peak, workers = measure(bench.func, bench.ops_per_call, min_time)
+        results[bench.name] = {"ops_per_sec": round(ops, 2),
+                               "peak_rss_kib": round(peak, 1)}
+        line = f"{bench.name:<28} {ops:>10.1f} ops/s {peak:>10.1f} KiB peak"
+        if workers:
+            results[bench.name]["worker_rss_kib"] = round(workers, 1)
+            line += f" {workers:>10.1f} KiB in workers"
+        print(line, file=stream)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, stream=sys.stdout):
+    """Return the names of benchmarks slower or bigger than baseline by more than tolerance.
+
+    Memory only counts as a regression once it also grew by more than
+    MEMORY_NOISE_KIB. Baselines saved before RSS was measured have no
+    memory figures and are compared on speed alone.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["ops_per_sec"]
+        after = result["ops_per_sec"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+        print(f"{name:<28} {before:>10.1f} -> {after:>10.1f} ops/s "
+              f"({change:+.0%}){flag}", file=stream)
+
+        for key, label in (("peak_rss_kib", "KiB peak"),
+                           ("worker_rss_kib", "KiB in workers")):
+            if key not in baseline[name] or key not in result:
+                continue
+            before, after = baseline[name][key], result[key]
+            grown = (after - before > MEMORY_NOISE_KIB and
+                     after > before * (1 + tolerance))
+            if grown:
+                flag = "  REGRESSION"
+            print(f"{'':<28} {before:>10.1f} -> {after:>10.1f} {label}"
+                  f"{'  REGRESSION' if grown else ''}", file=stream)
+
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark QR render, export, bulk and scan paths")
+    parser.add_argument("-k", "--filter",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=1.0,
+                        help="seconds to spend timing each benchmark")
+    parser.add_argument("--bulk-rows", type=int, default=200,
+                        help="rows per bulk batch")
+    parser.add_argument("--save", metavar="FILE", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against a baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown or memory growth before a comparison fails")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="qr_bench_")
+    try:
+        benchmarks = build_benchmarks(workdir, args.bulk_rows)
+        results = run_benchmarks(benchmarks, args.filter, args.min_time)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than "
+                  f"{args.tolerance:.0%}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,680 @@
+"""Headless bulk QR generation.
+
+Rows are rendered to PNG (or SVG) bytes in a pool of worker processes and written
+back by the parent in row order, so the output is identical to a
+sequential run no matter how many workers are used.
+
+The CSV is streamed: rows are read lazily and only a bounded number of
+chunks are in flight at once, so memory use doesn't grow with the input.
+
+Repeated rows are cheap: a payload already rendered with the same style
+is not sent to the workers again, and a loose file whose bytes were
+already written is hard-linked to the first copy instead.
+"""
+import argparse
+import csv
+import functools
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import qr_export
+import qr_render
+
+
+DEFAULT_NAMING_TEMPLATE = "{name}_{date}"
+
+# Renderers for each bulk output format, keyed by file extension
+OUTPUT_FORMATS = {
+    "png": qr_render.render_png,
+    "svg": qr_export.render_svg
+}
+
+# ZIP entry compression. PNG data is already deflated, so storing is
+# usually almost as small and much faster.
+ZIP_COMPRESSION = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED
+}
+
+# Black on white, high error correction: the historic bulk look
+DEFAULT_BULK_STYLE = qr_render.QRStyle(fill_color="black", bg_color="white")
+
+# Rendered files of recent rows kept for later duplicates. Duplicates
+# further apart than this are rendered again, never wrong.
+DEDUP_CACHE_BYTES = 64 * 1024 * 1024
+
+# Recent file hashes remembered for hard-linking, about 100 bytes each
+DEDUP_LINK_FILES = 100000
+
+
+@dataclass
+class BulkReport:
+    """Outcome of a bulk run"""
+    success_count: int = 0
+    errors: list = field(default_factory=list)  # (row number, message)
+    elapsed: float = 0.0
+    zip_path: str = ""
+    duplicates: int = 0  # rows served from an earlier row's render
+    linked: int = 0  # loose files hard-linked to an identical one
+    linked_bytes: int = 0  # bytes those links kept off the disk
+
+    @property
+    def row_count(self):
+        return self.success_count + len(self.errors)
+
+    @property
+    def rows_per_second(self):
+        return self.row_count / self.elapsed if self.elapsed else 0.0
+
+
+def iter_rows(path):
+    """Lazily yield CSV rows as dicts"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        yield from csv.DictReader(f)
+
+
+def count_rows(path):
+    """Count CSV data rows without keeping them in memory"""
+    return sum(1 for _ in iter_rows(path))
+
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def row_payload(row):
+    """Use first column as data, or None for an empty row"""
+    values = list(row.values())
+    return values[0] if values else None
+
+
+def row_filename(template, row, index, date, output_format="png"):
+    """Build the output filename for a row from the naming template"""
+    return template.format(
+        name=row.get('name', f'qr_{index:03d}'),
+        date=date,
+        index=index
+    ) + "." + output_format
+
+
+def content_key(data, style, output_format="png",
+                png_preset=qr_render.DEFAULT_PNG_PRESET):
+    """Hash of everything that decides the bytes a row renders to"""
+    if output_format == "png":
+        output_format += ":" + png_preset
+    text = f"{output_format}\0{style!r}\0{data}"
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"),
+                           digest_size=16).digest()
+
+
+class RenderCache:
+    """Rendered (file bytes, error) results of recent rows by content key.
+
+    claim() reserves a key as soon as its row is sent off for rendering,
+    so later rows with the same key are known to be duplicates before the
+    first result is back. Results are evicted oldest first once their
+    bytes exceed max_bytes. Every result costs at least ENTRY_BYTES, so
+    failed rows (no file bytes) are evicted too.
+    """
+
+    # Rough size of a key, its result tuple and the dict slot
+    ENTRY_BYTES = 256
+
+    def __init__(self, max_bytes=DEDUP_CACHE_BYTES):
+        self._entries = qr_render.BudgetedLRU(max_bytes, self._cost)
+
+    def claim(self, key):
+        """True if key was seen before; otherwise reserve it and return False"""
+        return self._entries.reserve(key)
+
+    def get(self, key):
+        """The stored result, or None if it was evicted"""
+        return self._entries.get(key)
+
+    def _cost(self, result):
+        content, error = result
+        return self.ENTRY_BYTES + len(content or b"") + len(error or "")
+
+    def put(self, key, result):
+        self._entries.put(key, result)
+
+
+def pool_context():
+    """Multiprocessing context for worker pools.
+
+    Workers are started from a clean server process (forkserver) or a
+    fresh interpreter (spawn), never forked from the caller: the GUI's
+    preview, thumbnail and camera threads may hold a cache or history
+    lock at that moment, and a forked worker would inherit it held.
+    Pool initializers pass everything workers need.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+# Style and renderer for the current worker process, set once by the
+# pool initializer
+_worker_style = None
+_worker_render = None
+
+
+def get_renderer(output_format="png", png_preset=qr_render.DEFAULT_PNG_PRESET):
+    """Return the render(data, style) function for an output format.
+
+    png_preset picks the PNG compression (a key of qr_render.PNG_PRESETS)
+    and is ignored for other formats.
+    """
+    render = OUTPUT_FORMATS[output_format]
+    if output_format == "png":
+        # Raise for a bad preset here rather than once per row in a worker
+        qr_render.png_save_options(png_preset)
+        render = functools.partial(render, preset=png_preset)
+    return render
+
+
+def _init_worker(style, output_format="png",
+                 png_preset=qr_render.DEFAULT_PNG_PRESET):
+    global _worker_style, _worker_render
+    _worker_style = style
+    _worker_render = get_renderer(output_format, png_preset)
+
+
+def _render(render, data, style):
+    """Render one payload, returning (file bytes, error message)"""
+    if not data:
+        return None, "Row has no data"
+    try:
+        return render(data, style), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _render_row(data):
+    return _render(_worker_render, data, _worker_style)
+
+
+def _render_chunk(payloads):
+    return [_render_row(data) for data in payloads]
+
+
+def render_rows(rows, style=DEFAULT_BULK_STYLE, workers=None, chunksize=32,
+                max_pending=None, output_format="png", dedup=True,
+                png_preset=qr_render.DEFAULT_PNG_PRESET):
+    """Yield (row, file bytes, error, duplicate) for each row, in input order.
+
+    At most max_pending chunks (default two per worker) are submitted
+    ahead of the one being consumed, which bounds memory for any input
+    size. workers=1 renders in this process, which is handy for debugging.
+
+    With dedup, a row whose payload already appeared earlier is not
+    rendered again: it gets the earlier row's result and duplicate=True.
+    """
+    cache = RenderCache() if dedup else None
+    render = get_renderer(output_format, png_preset)
+
+    def split(chunk):
+        """Plan a chunk: (key, duplicate) per row and the payloads to render"""
+        plan, payloads = [], []
+        for row in chunk:
+            data = row_payload(row)
+            key = None
+            if cache is not None and data:
+                key = content_key(data, style, output_format, png_preset)
+            duplicate = key is not None and cache.claim(key)
+            plan.append((key, duplicate))
+            if not duplicate:
+                payloads.append(data)
+        return plan, payloads
+
+    def merge(chunk, plan, results):
+        """Yield a chunk's rows with fresh results or reused ones"""
+        results = iter(results)
+        for row, (key, duplicate) in zip(chunk, plan):
+            if duplicate:
+                result = cache.get(key)
+                if result is None:
+                    # The first copy was evicted before this row came up
+                    result = _render(render, row_payload(row), style)
+                    cache.put(key, result)
+            else:
+                result = next(results)
+                if key is not None:
+                    cache.put(key, result)
+            yield (row,) + result + (duplicate,)
+
+    if workers == 1:
+        for chunk in iter_chunks(rows, chunksize):
+            plan, payloads = split(chunk)
+            yield from merge(chunk, plan, [_render(render, data, style)
+                                           for data in payloads])
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(),
+                             initializer=_init_worker,
+                             initargs=(style, output_format,
+                                       png_preset)) as pool:
+        for chunk in iter_chunks(rows, chunksize):
+            plan, payloads = split(chunk)
+            # Chunks of nothing but duplicates never go to the pool
+            future = pool.submit(_render_chunk, payloads) if payloads else None
+            pending.append((chunk, plan, future))
+            if len(pending) >= max_pending:
+                chunk, plan, future = pending.popleft()
+                yield from merge(chunk, plan, future.result() if future else [])
+
+        while pending:
+            chunk, plan, future = pending.popleft()
+            yield from merge(chunk, plan, future.result() if future else [])
+
+
+class BulkWriter:
+    """Writes rendered files as loose files, ZIP entries, or both.
+
+    File bytes go straight from memory into the archive, so nothing is
+    written to disk twice and unrelated files in output_dir are never
+    picked up.
+
+    With dedup, a loose file with the same bytes as one written recently
+    becomes a hard link to it (or is written out as usual where links
+    aren't supported). ZIP entries can't share data, so the archive always gets
+    the bytes again.
+
+    A repeated filename raises ValueError. With an archive the check uses
+    the ZIP's own entry index. Loose files only are checked against a set
+    of every name written so far, which grows by one short string per
+    row, about 100 bytes.
+    """
+
+    def __init__(self, output_dir, zip_name="qr_codes.zip",
+                 write_files=True, compression="stored", dedup=True):
+        self.output_dir = output_dir
+        self.write_files = write_files
+        self.dedup = dedup
+        self.zip_path = os.path.join(output_dir, zip_name) if zip_name else ""
+        self.linked = 0
+        self.linked_bytes = 0
+        self._zipf = None
+        self._names = None if zip_name else set()
+        self._written = OrderedDict()  # content hash -> path, most recent last
+
+        if not (write_files or zip_name):
+            raise ValueError("Nothing to write: enable files or a ZIP archive")
+        if self.zip_path:
+            self._zipf = zipfile.ZipFile(self.zip_path, 'w',
+                                         compression=ZIP_COMPRESSION[compression])
+
+    def write(self, filename, content):
+        """Write one rendered file under filename"""
+        names = self._zipf.NameToInfo if self._zipf else self._names
+        if filename in names:
+            raise ValueError(f"Duplicate filename: {filename}")
+        if not self._zipf:
+            self._names.add(filename)
+
+        if self.write_files:
+            path = os.path.join(self.output_dir, filename)
+            # Never write through an existing file: an earlier run may have
+            # hard-linked it to others
+            if os.path.lexists(path):
+                os.remove(path)
+            if self.dedup:
+                self._write_deduplicated(path, content)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(content)
+        if self._zipf:
+            self._zipf.writestr(filename, content)
+
+    def _write_deduplicated(self, path, content):
+        key = hashlib.blake2b(content, digest_size=16).digest()
+        first = self._written.get(key)
+        if first is not None:
+            try:
+                os.link(first, path)
+            except OSError:
+                pass
+            else:
+                self._written.move_to_end(key)
+                self.linked += 1
+                self.linked_bytes += len(content)
+                return
+
+        with open(path, 'wb') as f:
+            f.write(content)
+        self._written[key] = path
+        if len(self._written) > DEDUP_LINK_FILES:
+            self._written.popitem(last=False)
+
+    def close(self):
+        if self._zipf:
+            self._zipf.close()
+            self._zipf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def generate_bulk(rows, output_dir, style=DEFAULT_BULK_STYLE,
+                  naming_template=DEFAULT_NAMING_TEMPLATE, workers=None,
+                  chunksize=32, zip_name="qr_codes.zip", write_files=True,
+                  zip_compression="stored", output_format="png",
+                  dedup=True, png_preset=qr_render.DEFAULT_PNG_PRESET,
+                  progress=None):
+    """Render every row to output_dir and return a BulkReport.
+
+    rows can be any iterable, e.g. iter_rows(path), and is consumed lazily.
+    output_format is a key of OUTPUT_FORMATS and png_preset one of
+    qr_render.PNG_PRESETS. Set zip_name to None to skip the archive, or
+    write_files to False to only produce the archive. dedup renders
+    repeated payloads once and hard-links their files. Failures are
+    recorded per row in the report instead of aborting the run. progress,
+    if given, is called with the number of rows handled so far.
+    """
+    start = time.perf_counter()
+    report = BulkReport()
+    date = datetime.now().strftime("%Y%m%d")
+
+    with BulkWriter(output_dir, zip_name, write_files, zip_compression,
+                    dedup) as writer:
+        report.zip_path = writer.zip_path
+        results = render_rows(rows, style, workers, chunksize,
+                              output_format=output_format, dedup=dedup,
+                              png_preset=png_preset)
+        for i, (row, content, error, duplicate) in enumerate(results, start=1):
+            if error is None:
+                try:
+                    filename = row_filename(naming_template, row, i, date,
+                                            output_format)
+                    writer.write(filename, content)
+                except Exception as e:
+                    error = str(e)
+
+            if error is None:
+                report.success_count += 1
+                report.duplicates += duplicate
+            else:
+                report.errors.append((i, error))
+
+            if progress:
+                progress(i)
+
+        report.linked = writer.linked
+        report.linked_bytes = writer.linked_bytes
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def generate_label_sheet(rows, output, style=DEFAULT_BULK_STYLE,
+                         layout=qr_export.LabelSheetLayout(),
+                         caption_column=None, progress=None):
+    """Lay every row out on a multi-page PDF label sheet.
+
+    The caption is taken from caption_column if given, otherwise it is the
+    payload. Returns a BulkReport; rows that fail to encode are skipped
+    and recorded without leaving a gap on the sheet.
+    """
+    start = time.perf_counter()
+    report = BulkReport(zip_path="")
+
+    with qr_export.LabelSheet(output, style, layout) as sheet:
+        for i, row in enumerate(rows, start=1):
+            data = row_payload(row)
+            try:
+                if not data:
+                    raise ValueError("Row has no data")
+                caption = row.get(caption_column) if caption_column else None
+                sheet.add(data, caption)
+                report.success_count += 1
+            except Exception as e:
+                report.errors.append((i, str(e)))
+
+            if progress:
+                progress(i)
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+class ProgressBar:
+    """Single-line progress bar with throughput, redrawn at most every interval"""
+
+    def __init__(self, total=None, stream=sys.stderr, width=30, interval=0.2):
+        self.total = total
+        self.stream = stream
+        self.width = width
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._last_draw = 0.0
+
+    def __call__(self, done):
+        now = time.perf_counter()
+        if now - self._last_draw < self.interval and done != self.total:
+            return
+        self._last_draw = now
+
+        rate = done / (now - self.start) if now > self.start else 0.0
+        if self.total:
+            filled = self.width * done // self.total
+            bar = "#" * filled + "-" * (self.width - filled)
+            line = f"[{bar}] {done}/{self.total} rows  {rate:.1f} rows/s"
+        else:
+            line = f"{done} rows  {rate:.1f} rows/s"
+        self.stream.write("\r" + line)
+        self.stream.flush()
+
+    def finish(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+def positive_int(text):
+    """argparse type for counts that must be at least 1"""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def add_style_arguments(parser):
+    """Add the options shared by every bulk command that picks a style"""
+    parser.add_argument("--ec", choices=list(qr_render.ERROR_CORRECTION_LEVELS),
+                        default="H", help="error correction level")
+    parser.add_argument("--fill", default="black", help="module color")
+    parser.add_argument("--bg", default="white", help="background color")
+    parser.add_argument("--shape", choices=list(qr_render.MODULE_SHAPES),
+                        default="squares", help="module shape")
+    parser.add_argument("--eyes", choices=list(qr_render.EYE_PATTERNS),
+                        default="default", help="finder pattern style")
+    parser.add_argument("--logo", default="", help="logo image pasted in the centre")
+    parser.add_argument("--logo-shape", choices=list(qr_render.LOGO_SHAPES),
+                        default="circle")
+    parser.add_argument("--mask", type=int, choices=range(8), default=None,
+                        help="use this data mask instead of scoring all eight "
+                             "(for codes already verified to scan)")
+
+
+def style_from_args(args):
+    """Build the QRStyle selected by add_style_arguments options"""
+    return DEFAULT_BULK_STYLE.with_options(
+        fill_color=args.fill, bg_color=args.bg,
+        module_shape=args.shape, eye_pattern=args.eyes,
+        logo_path=args.logo, logo_shape=args.logo_shape,
+        mask_pattern=args.mask,
+        error_correction=qr_render.error_correction_from_label(args.ec))
+
+
+def print_summary(report):
+    """Print per-row errors and the timing summary of a report"""
+    for row, error in report.errors:
+        print(f"Row {row}: {error}", file=sys.stderr)
+
+    print(f"Rows:      {report.row_count}")
+    print(f"Generated: {report.success_count}")
+    print(f"Failed:    {len(report.errors)}")
+    print(f"Elapsed:   {report.elapsed:.2f}s")
+    print(f"Rate:      {report.rows_per_second:.1f} rows/s")
+    if report.duplicates or report.linked:
+        print(f"Repeated:  {report.duplicates} rows reused an earlier render, "
+              f"{report.linked} files hard-linked "
+              f"({report.linked_bytes / 1024:.0f} KiB not written)")
+    if report.zip_path:
+        print(f"ZIP:       {report.zip_path}")
+
+
+def build_arg_parser(parser=None):
+    """Add the bulk command-line options to parser (or a new one)"""
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            prog="qr_bulk", description="Generate QR codes from a CSV file")
+    parser.add_argument("input", help="CSV file, first column is encoded")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="directory for PNG files and the ZIP archive")
+    parser.add_argument("--zip", dest="zip_name", default="qr_codes.zip",
+                        help="ZIP archive name inside the output directory")
+    parser.add_argument("--no-zip", action="store_true",
+                        help="don't create a ZIP archive")
+    parser.add_argument("--no-files", action="store_true",
+                        help="only write the ZIP archive, no loose files")
+    parser.add_argument("-f", "--format", dest="output_format",
+                        choices=list(OUTPUT_FORMATS), default="png",
+                        help="output file format")
+    parser.add_argument("--zip-compression", choices=list(ZIP_COMPRESSION),
+                        default="stored")
+    parser.add_argument("--png-compression", choices=list(qr_render.PNG_PRESETS),
+                        default=qr_render.DEFAULT_PNG_PRESET,
+                        help="PNG compression preset: fast writes quickest, "
+                             "smallest gives the smallest files")
+    parser.add_argument("-t", "--template", default=DEFAULT_NAMING_TEMPLATE,
+                        help="naming template using {name}, {date}, {index}")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="render and write repeated rows separately "
+                             "instead of reusing and hard-linking")
+    add_style_arguments(parser)
+    parser.add_argument("-w", "--workers", type=positive_int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunksize", type=positive_int, default=32,
+                        help="rows sent to a worker at a time")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="no progress bar")
+    return parser
+
+
+def run_cli(args):
+    """Run a bulk job from parsed arguments and print a summary"""
+    if not os.path.isfile(args.input):
+        print(f"Input file not found: {args.input}", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    style = style_from_args(args)
+
+    progress = None
+    if not args.quiet:
+        progress = ProgressBar(total=count_rows(args.input))
+
+    try:
+        report = generate_bulk(
+            iter_rows(args.input), args.output_dir, style=style,
+            naming_template=args.template, workers=args.workers,
+            chunksize=args.chunksize,
+            zip_name=None if args.no_zip else args.zip_name,
+            write_files=not args.no_files,
+            zip_compression=args.zip_compression,
+            output_format=args.output_format, dedup=not args.no_dedup,
+            png_preset=args.png_compression, progress=progress)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if progress:
+            progress.finish()
+
+    print_summary(report)
+    return 1 if report.errors else 0
+
+
+def build_labels_arg_parser(parser=None):
+    """Add the label-sheet command-line options to parser (or a new one)"""
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            prog="qr_bulk labels",
+            description="Lay out QR codes from a CSV file on PDF label sheets")
+    parser.add_argument("input", help="CSV file, first column is encoded")
+    parser.add_argument("output", help="PDF file to write")
+    parser.add_argument("--columns", type=positive_int, default=3)
+    parser.add_argument("--rows", type=positive_int, default=4)
+    parser.add_argument("--margin", type=float, default=36,
+                        help="page margin in points")
+    parser.add_argument("--gutter", type=float, default=12,
+                        help="space between labels in points")
+    parser.add_argument("--caption-size", type=float, default=8,
+                        help="caption font size, 0 for no captions")
+    parser.add_argument("--caption-column",
+                        help="CSV column used as caption (default: the payload)")
+    add_style_arguments(parser)
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="no progress bar")
+    return parser
+
+
+def run_labels_cli(args):
+    """Write a label sheet from parsed arguments and print a summary"""
+    if not os.path.isfile(args.input):
+        print(f"Input file not found: {args.input}", file=sys.stderr)
+        return 2
+
+    layout = qr_export.LabelSheetLayout(
+        columns=args.columns, rows=args.rows, margin=args.margin,
+        gutter=args.gutter, caption_size=args.caption_size)
+
+    progress = None
+    if not args.quiet:
+        progress = ProgressBar(total=count_rows(args.input))
+
+    try:
+        report = generate_label_sheet(
+            iter_rows(args.input), args.output, style=style_from_args(args),
+            layout=layout, caption_column=args.caption_column,
+            progress=progress)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if progress:
+            progress.finish()
+
+    print_summary(report)
+    print(f"PDF:       {args.output}")
+    return 1 if report.errors else 0
+
+
+def main(argv=None):
+    return run_cli(build_arg_parser().parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
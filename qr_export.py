@@ -0,0 +1,270 @@
+"""Vector export backends.
+
+QR codes are drawn straight from the cached module matrix: each
+horizontal run of dark modules becomes one rectangle, so output stays
+small and nothing round-trips through a temporary raster file.
+"""
+import base64
+from io import BytesIO, StringIO
+from dataclasses import dataclass
+
+import svgwrite
+
+from reportlab.lib.colors import Color
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+import qr_render
+
+
+CAPTION_FONT = "Helvetica"
+
+
+def _svg_color(color):
+    return "#%02x%02x%02x" % qr_render.parse_color(color)
+
+
+def _svg_gradient(dwg, style, size):
+    """Add the style's gradient to the SVG defs and return its paint server"""
+    if style.gradient_mode == "radial":
+        gradient = dwg.radialGradient(center=(size / 2, size / 2),
+                                      r=size / 2 * 2 ** 0.5,
+                                      gradientUnits="userSpaceOnUse")
+    else:
+        end = {"vertical": (0, size), "diagonal": (size, size)}.get(
+            style.gradient_mode, (size, 0))
+        gradient = dwg.linearGradient(start=(0, 0), end=end,
+                                      gradientUnits="userSpaceOnUse")
+    gradient.add_stop_color(0, _svg_color(style.gradient_start))
+    gradient.add_stop_color(1, _svg_color(style.gradient_end))
+    dwg.defs.add(gradient)
+    return gradient.get_paint_server()
+
+
+def render_svg(data, style=qr_render.DEFAULT_STYLE, cache=qr_render.MATRIX_CACHE):
+    """Render the QR code as compact SVG bytes.
+
+    All dark modules go into a single <path>, one subpath per horizontal
+    run, in module units via the viewBox. That is an order of magnitude
+    smaller than one <rect> per module.
+    """
+    encoded = cache.get(data, style.error_correction, style.mask_pattern)
+    matrix = qr_render.padded_matrix(encoded, style.border)
+    size = matrix.shape[0]
+    pixels = size * style.box_size
+
+    dwg = svgwrite.Drawing(size=(pixels, pixels), viewBox=f"0 0 {size} {size}",
+                           debug=False)
+    dwg["shape-rendering"] = "crispEdges"
+    if not style.transparent_bg:
+        dwg.add(dwg.rect((0, 0), (size, size), fill=_svg_color(style.bg_color)))
+
+    if style.use_gradient:
+        fill = _svg_gradient(dwg, style, size)
+    else:
+        fill = _svg_color(style.fill_color)
+
+    rows, starts, lengths = qr_render.module_runs(matrix)
+    path = "".join(f"M{start} {row}h{length}v1h-{length}z" for row, start, length
+                   in zip(rows.tolist(), starts.tolist(), lengths.tolist()))
+    dwg.add(dwg.path(d=path, fill=fill))
+
+    if style.logo_path:
+        # Same proportions as the raster path: 20% of the code
+        sprite = qr_render.LOGO_CACHE.get(style.logo_path, pixels // 5,
+                                          style.logo_shape)
+        href = "data:image/png;base64," + base64.b64encode(
+            qr_render.image_to_png_bytes(sprite)).decode("ascii")
+        logo_size = size / 5
+        offset = (size - logo_size) / 2
+        dwg.add(dwg.image(href, insert=(offset, offset),
+                          size=(logo_size, logo_size)))
+
+    buffer = StringIO()
+    dwg.write(buffer)
+    return buffer.getvalue().encode("utf-8")
+
+
+def _pdf_color(color):
+    r, g, b = qr_render.parse_color(color)
+    return Color(r / 255, g / 255, b / 255)
+
+
+def _fill_gradient(c, style, x, y, size):
+    """Fill the current clip region with the style's gradient"""
+    colors = (_pdf_color(style.gradient_start), _pdf_color(style.gradient_end))
+    top = y + size
+    if style.gradient_mode == "vertical":
+        c.linearGradient(x, top, x, y, colors, extend=True)
+    elif style.gradient_mode == "diagonal":
+        c.linearGradient(x, top, x + size, y, colors, extend=True)
+    elif style.gradient_mode == "radial":
+        c.radialGradient(x + size / 2, y + size / 2, size / 2 * 2 ** 0.5,
+                         colors, extend=True)
+    else:
+        c.linearGradient(x, y, x + size, y, colors, extend=True)
+
+
+def draw_code(c, data, style, x, y, size, cache=qr_render.MATRIX_CACHE):
+    """Draw a QR code as vector rectangles with its bottom-left corner at (x, y)"""
+    encoded = cache.get(data, style.error_correction, style.mask_pattern)
+    matrix = qr_render.padded_matrix(encoded, style.border)
+    module = size / matrix.shape[0]
+
+    c.saveState()
+    if not style.transparent_bg:
+        c.setFillColor(_pdf_color(style.bg_color))
+        c.rect(x, y, size, size, fill=1, stroke=0)
+
+    path = c.beginPath()
+    rows, starts, lengths = qr_render.module_runs(matrix)
+    for row, start, length in zip(rows.tolist(), starts.tolist(), lengths.tolist()):
+        path.rect(x + start * module, y + size - (row + 1) * module,
+                  length * module, module)
+
+    if style.use_gradient:
+        c.clipPath(path, stroke=0, fill=0)
+        _fill_gradient(c, style, x, y, size)
+    else:
+        c.setFillColor(_pdf_color(style.fill_color))
+        c.drawPath(path, fill=1, stroke=0)
+    c.restoreState()
+
+    if style.logo_path:
+        # Same proportions as the raster path: 20% of the code
+        pixels = matrix.shape[0] * style.box_size // 5
+        sprite = qr_render.LOGO_CACHE.get(style.logo_path, pixels,
+                                          style.logo_shape)
+        logo_size = size / 5
+        c.drawImage(ImageReader(sprite), x + (size - logo_size) / 2,
+                    y + (size - logo_size) / 2, logo_size, logo_size,
+                    mask='auto')
+
+
+def render_pdf(data, style=qr_render.DEFAULT_STYLE):
+    """Render the QR code onto a single letter-sized PDF page"""
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    draw_code(c, data, style, 100, 500, 200)
+    c.setFont(CAPTION_FONT, 12)
+    c.drawString(100, 480, f"QR Code: {data[:50]}...")
+    c.save()
+    return buffer.getvalue()
+
+
+@dataclass(frozen=True)
+class LabelSheetLayout:
+    """Grid of labels on a page, all measurements in points"""
+    pagesize: tuple = letter
+    columns: int = 3
+    rows: int = 4
+    margin: float = 36
+    gutter: float = 12
+    caption_size: float = 8  # 0 disables captions
+
+    @property
+    def per_page(self):
+        return self.columns * self.rows
+
+    def cell_size(self):
+        """Return (width, height) of one label cell"""
+        page_width, page_height = self.pagesize
+        width = (page_width - 2 * self.margin -
+                 (self.columns - 1) * self.gutter) / self.columns
+        height = (page_height - 2 * self.margin -
+                  (self.rows - 1) * self.gutter) / self.rows
+        return width, height
+
+
+def fit_caption(text, width, font_size, font=CAPTION_FONT):
+    """Truncate text with '...' so it fits in width points"""
+    text = " ".join(text.split())
+    if stringWidth(text, font, font_size) <= width:
+        return text
+
+    # Start from a rough cut so very long payloads don't loop per character
+    text = text[:max(1, int(width / (font_size * 0.4)))]
+    while text and stringWidth(text + "...", font, font_size) > width:
+        text = text[:-1]
+    return text + "..."
+
+
+class LabelSheet:
+    """Multi-page PDF of QR labels, written in a single pass.
+
+    Codes are encoded before a cell is used, so add() can raise for a bad
+    payload without leaving a gap on the sheet.
+    """
+
+    def __init__(self, output, style=qr_render.DEFAULT_STYLE,
+                 layout=LabelSheetLayout()):
+        self.style = style
+        self.layout = layout
+        self.count = 0
+        self._canvas = canvas.Canvas(output, pagesize=layout.pagesize)
+
+        cell_width, cell_height = layout.cell_size()
+        caption_height = layout.caption_size * 1.5 if layout.caption_size else 0
+        self._cell = (cell_width, cell_height)
+        self._caption_height = caption_height
+        self._code_size = min(cell_width, cell_height - caption_height)
+        if self._code_size <= 0:
+            raise ValueError("Label cells are too small for the page size")
+
+    @property
+    def pages(self):
+        return -(-self.count // self.layout.per_page)
+
+    def add(self, data, caption=None):
+        """Place the next code (and optional caption) on the sheet"""
+        qr_render.MATRIX_CACHE.get(data, self.style.error_correction,
+                                   self.style.mask_pattern)
+
+        layout = self.layout
+        slot = self.count % layout.per_page
+        if slot == 0 and self.count:
+            self._canvas.showPage()
+
+        column, row = slot % layout.columns, slot // layout.columns
+        cell_width, cell_height = self._cell
+        page_height = layout.pagesize[1]
+        left = layout.margin + column * (cell_width + layout.gutter)
+        top = page_height - layout.margin - row * (cell_height + layout.gutter)
+
+        x = left + (cell_width - self._code_size) / 2
+        y = top - self._code_size
+        draw_code(self._canvas, data, self.style, x, y, self._code_size)
+
+        if layout.caption_size:
+            text = fit_caption(data if caption is None else caption,
+                               cell_width, layout.caption_size)
+            self._canvas.setFont(CAPTION_FONT, layout.caption_size)
+            self._canvas.drawCentredString(left + cell_width / 2,
+                                           y - layout.caption_size * 1.2, text)
+        self.count += 1
+
+    def close(self):
+        self._canvas.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_label_sheet(items, output, style=qr_render.DEFAULT_STYLE,
+                      layout=LabelSheetLayout()):
+    """Write payloads (or (payload, caption) pairs) as a label sheet PDF.
+
+    output is a path or a binary file object. Returns the number of labels.
+    """
+    with LabelSheet(output, style, layout) as sheet:
+        for item in items:
+            if isinstance(item, str):
+                sheet.add(item)
+            else:
+                sheet.add(*item)
+        return sheet.count
@@ -1,28 +1,32 @@
 import qrcode
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser, scrolledtext
-from PIL import Image, ImageTk, ImageDraw, ImageFont, ImageOps
+from PIL import ImageTk, ImageFont, ImageOps
 import json
 import os
+import sys
+import argparse
 from datetime import datetime
 import webbrowser
 import csv
-import zipfile
 import tempfile
 import shutil
 from pathlib import Path
+from itertools import islice
+from collections import OrderedDict
 import threading
 import time
 import cv2
-import numpy as np
 from io import BytesIO
 import base64
 import requests
 import svgwrite
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
-import qrcode.image.svg
+import qr_render
+import qr_bulk
+import qr_export
+import qr_scan
+import qr_history
 
 
 class ModernQRGenerator:
@@ -47,26 +51,53 @@ class ModernQRGenerator:
         self.fill_color = tk.StringVar(value="#000000")
         self.bg_color = tk.StringVar(value="#FFFFFF")
         self.logo_path = tk.StringVar()
+        self.logo_shape = tk.StringVar(value="circle")
         self.qr_size = tk.IntVar(value=300)
         self.border_size = tk.IntVar(value=4)
         self.error_correction = tk.StringVar(value="H (High)")
         self.wifi_security = tk.StringVar(value="WPA")
         self.qr_shape = tk.StringVar(value="squares")
+        self.eye_pattern = tk.StringVar(value="default")
+        self.mask_pattern = tk.StringVar(value="Auto")
         self.gradient_start = tk.StringVar(value="#000000")
         self.gradient_end = tk.StringVar(value="#000000")
         self.use_gradient = tk.BooleanVar(value=False)
+        self.gradient_mode = tk.StringVar(value="horizontal")
         self.transparent_bg = tk.BooleanVar(value=False)
+        self.png_preset = tk.StringVar(value=qr_render.DEFAULT_PNG_PRESET)
 
         # Data type tracking
         self.current_data_type = tk.StringVar(value="text")
 
         # History and preferences
-        self.history_data = []
+        self.history = None
+        self.history_last_entry = None
+        self.history_exhausted = False
+        self.history_page_pending = False
+        self.history_search_job = None
+        self.history_query = tk.StringVar()
+        self.history_type_filter = tk.StringVar(value="All")
+        self.history_since = tk.StringVar()
+        self.history_until = tk.StringVar()
         self.user_preferences = {}
 
+        # History thumbnails: cached on disk, rendered only for rows in
+        # view, and at most history_thumbnail_limit kept as Tk images
+        self.thumbnail_cache = qr_history.ThumbnailCache()
+        self.thumbnail_loader = qr_history.ThumbnailLoader(
+            self.render_history_thumbnail, self.deliver_history_thumbnail)
+        self.history_thumbnails = OrderedDict()
+        self.history_thumbnail_limit = 500
+
         # Camera and scanning
         self.camera_active = False
-        self.cap = None
+        self.camera_scanner = None
+        self.scan_results = qr_scan.ScanResults()
+        self.scan_rate = tk.IntVar(value=10)
+
+        # Background preview worker, replaces a thread per keystroke
+        self.preview_scheduler = qr_render.PreviewScheduler(
+            self.generate_preview, self.deliver_preview)
 
         self.setup_ui()
         self.load_history()
@@ -108,6 +139,9 @@ class ModernQRGenerator:
                              borderwidth=2,
                              relief='solid')
 
+        self.style.configure('History.Treeview',
+                             rowheight=qr_history.THUMBNAIL_SIZE + 4)
+
     def setup_ui(self):
         """Setup the modern user interface with sidebar navigation"""
         # Header with theme toggle
@@ -201,6 +235,15 @@ class ModernQRGenerator:
                                        background='white', relief='solid', borderwidth=1)
         self.preview_label.pack(pady=10, ipadx=80, ipady=80)
 
+        self.preview_latency_label = ttk.Label(
+            preview_container, text="", foreground="gray")
+        self.preview_latency_label.pack()
+
+        # Version and segments the saved code will use
+        self.preview_plan_label = ttk.Label(
+            preview_container, text="", foreground="gray", wraplength=260)
+        self.preview_plan_label.pack()
+
         # Advanced customization section
         self.setup_advanced_customization(preview_frame)
 
@@ -246,22 +289,43 @@ class ModernQRGenerator:
         ttk.Button(gradient_frame, text="End Color",
                    command=lambda: self.choose_gradient_color('end')).pack(side='left', padx=5)
 
+        gradient_combo = ttk.Combobox(gradient_frame, textvariable=self.gradient_mode,
+                                      values=list(qr_render.GRADIENT_MODES),
+                                      state='readonly', width=12)
+        gradient_combo.pack(side='left', padx=5)
+        gradient_combo.bind('<<ComboboxSelected>>',
+                            self.update_real_time_preview)
+
         # Shape selection
         shape_frame = ttk.Frame(colors_tab)
         shape_frame.pack(fill='x', pady=5)
 
         ttk.Label(shape_frame, text="QR Shape:").pack(side='left')
         shape_combo = ttk.Combobox(shape_frame, textvariable=self.qr_shape,
-                                   values=["squares", "dots",
-                                           "rounded", "circles"],
+                                   values=list(qr_render.MODULE_SHAPES),
                                    state='readonly')
         shape_combo.pack(side='left', padx=5)
         shape_combo.bind('<<ComboboxSelected>>', self.update_real_time_preview)
 
+        # Pinning the mask skips scoring all eight; only for verified codes
+        ttk.Label(shape_frame, text="Mask:").pack(side='left', padx=(10, 0))
+        mask_combo = ttk.Combobox(shape_frame, textvariable=self.mask_pattern,
+                                  values=["Auto"] + [str(i) for i in range(8)],
+                                  state='readonly', width=5)
+        mask_combo.pack(side='left', padx=5)
+        mask_combo.bind('<<ComboboxSelected>>', self.update_real_time_preview)
+
         # Export tab
         export_tab = ttk.Frame(notebook)
         notebook.add(export_tab, text="Export")
 
+        png_frame = ttk.Frame(export_tab)
+        png_frame.pack(pady=5)
+        ttk.Label(png_frame, text="PNG Compression:").pack(side='left')
+        ttk.Combobox(png_frame, textvariable=self.png_preset,
+                     values=list(qr_render.PNG_PRESETS), state='readonly',
+                     width=10).pack(side='left', padx=5)
+
         export_buttons = [
             ("Export as PNG", self.export_png),
             ("Export as SVG", self.export_svg),
@@ -298,6 +362,14 @@ class ModernQRGenerator:
                    command=self.stop_camera).pack(side='left', padx=5)
         ttk.Button(controls_frame, text="Upload Image to Scan",
                    command=self.scan_from_image).pack(side='left', padx=5)
+        ttk.Button(controls_frame, text="Clear Results",
+                   command=self.clear_scan_results).pack(side='left', padx=5)
+        ttk.Label(controls_frame, text="Decodes/s:").pack(side='left', padx=(15, 0))
+        ttk.Spinbox(controls_frame, from_=1, to=30, textvariable=self.scan_rate,
+                    width=4).pack(side='left', padx=5)
+
+        self.camera_stats_label = ttk.Label(scanner_frame, text="")
+        self.camera_stats_label.pack(anchor='w')
 
         # Results
         self.scan_result = scrolledtext.ScrolledText(scanner_frame, height=4)
@@ -457,12 +529,64 @@ class ModernQRGenerator:
         options_frame.pack(fill='x', pady=10)
 
         ttk.Label(options_frame, text="Naming Template:").pack(side='left')
-        self.naming_template = tk.StringVar(value="{name}_{date}")
+        self.naming_template = tk.StringVar(
+            value=qr_bulk.DEFAULT_NAMING_TEMPLATE)
         ttk.Entry(options_frame, textvariable=self.naming_template,
                   width=30).pack(side='left', padx=5)
 
-        ttk.Button(bulk_frame, text="Generate Bulk QR Codes",
-                   command=self.generate_bulk_qr, style='Success.TButton').pack(pady=20)
+        ttk.Label(options_frame, text="Workers:").pack(side='left', padx=(10, 0))
+        self.bulk_workers = tk.IntVar(value=os.cpu_count() or 1)
+        ttk.Spinbox(options_frame, from_=1, to=64, textvariable=self.bulk_workers,
+                    width=5).pack(side='left', padx=5)
+
+        output_frame = ttk.Frame(bulk_frame)
+        output_frame.pack(fill='x', pady=5)
+
+        self.bulk_write_files = tk.BooleanVar(value=True)
+        ttk.Checkbutton(output_frame, text="Save individual files",
+                        variable=self.bulk_write_files).pack(side='left')
+
+        ttk.Label(output_frame, text="Format:").pack(side='left', padx=(10, 0))
+        self.bulk_format = tk.StringVar(value="png")
+        ttk.Combobox(output_frame, textvariable=self.bulk_format,
+                     values=list(qr_bulk.OUTPUT_FORMATS), state='readonly',
+                     width=6).pack(side='left', padx=5)
+
+        ttk.Label(output_frame, text="ZIP Compression:").pack(
+            side='left', padx=(10, 0))
+        self.bulk_zip_compression = tk.StringVar(value="stored")
+        ttk.Combobox(output_frame, textvariable=self.bulk_zip_compression,
+                     values=list(qr_bulk.ZIP_COMPRESSION), state='readonly',
+                     width=10).pack(side='left', padx=5)
+
+        ttk.Label(output_frame, text="PNG Compression:").pack(
+            side='left', padx=(10, 0))
+        self.bulk_png_preset = tk.StringVar(value=self.png_preset.get())
+        ttk.Combobox(output_frame, textvariable=self.bulk_png_preset,
+                     values=list(qr_render.PNG_PRESETS), state='readonly',
+                     width=10).pack(side='left', padx=5)
+
+        sheet_frame = ttk.Frame(bulk_frame)
+        sheet_frame.pack(fill='x', pady=5)
+
+        ttk.Label(sheet_frame, text="Label Sheet Columns:").pack(side='left')
+        self.sheet_columns = tk.IntVar(value=3)
+        ttk.Spinbox(sheet_frame, from_=1, to=20, textvariable=self.sheet_columns,
+                    width=5).pack(side='left', padx=5)
+        ttk.Label(sheet_frame, text="Rows:").pack(side='left', padx=(10, 0))
+        self.sheet_rows = tk.IntVar(value=4)
+        ttk.Spinbox(sheet_frame, from_=1, to=30, textvariable=self.sheet_rows,
+                    width=5).pack(side='left', padx=5)
+
+        buttons_frame = ttk.Frame(bulk_frame)
+        buttons_frame.pack(pady=20)
+        ttk.Button(buttons_frame, text="Generate Bulk QR Codes",
+                   command=self.generate_bulk_qr, style='Success.TButton').pack(side='left', padx=5)
+        ttk.Button(buttons_frame, text="Export PDF Label Sheet",
+                   command=self.export_label_sheet, style='Primary.TButton').pack(side='left', padx=5)
+
+        self.bulk_status_label = ttk.Label(bulk_frame, text="", foreground='gray')
+        self.bulk_status_label.pack()
 
     def show_business_tab(self):
         """Show business features tab"""
@@ -479,6 +603,13 @@ class ModernQRGenerator:
 
         ttk.Button(branding_frame, text="Add Company Logo",
                    command=self.add_company_logo).pack(pady=5)
+
+        logo_shape_frame = ttk.Frame(branding_frame)
+        logo_shape_frame.pack(pady=5)
+        ttk.Label(logo_shape_frame, text="Logo Shape:").pack(side='left')
+        ttk.Combobox(logo_shape_frame, textvariable=self.logo_shape,
+                     values=list(qr_render.LOGO_SHAPES),
+                     state='readonly', width=10).pack(side='left', padx=5)
         ttk.Button(branding_frame, text="Set Brand Colors",
                    command=self.set_brand_colors).pack(pady=5)
 
@@ -539,10 +670,11 @@ class ModernQRGenerator:
         # Eye patterns
         ttk.Label(creative_frame, text="Eye Patterns:").pack(
             anchor='w', pady=5)
-        self.eye_pattern = tk.StringVar(value="default")
         eye_combo = ttk.Combobox(creative_frame, textvariable=self.eye_pattern,
-                                 values=["default", "circle", "rounded", "diamond"])
+                                 values=list(qr_render.EYE_PATTERNS),
+                                 state='readonly')
         eye_combo.pack(anchor='w', pady=5)
+        eye_combo.bind('<<ComboboxSelected>>', self.update_real_time_preview)
 
         # Animated QR
         ttk.Button(creative_frame, text="Create Animated QR",
@@ -556,13 +688,57 @@ class ModernQRGenerator:
             self.content_frame, text="Generation History", padding=15)
         history_frame.pack(fill='both', expand=True, padx=10, pady=5)
 
+        # Search and filters, applied as you type
+        filter_frame = ttk.Frame(history_frame)
+        filter_frame.pack(fill='x')
+
+        ttk.Label(filter_frame, text="Search:").pack(side='left')
+        search_entry = ttk.Entry(filter_frame, textvariable=self.history_query,
+                                 width=30)
+        search_entry.pack(side='left', padx=5)
+        ttk.Label(filter_frame, text="Type:").pack(side='left', padx=(10, 0))
+        type_combo = ttk.Combobox(filter_frame, textvariable=self.history_type_filter,
+                                  values=["All"] + list(qr_history.ENTRY_TYPES),
+                                  state='readonly', width=10)
+        type_combo.pack(side='left', padx=5)
+        ttk.Label(filter_frame, text="From:").pack(side='left', padx=(10, 0))
+        since_entry = ttk.Entry(filter_frame, textvariable=self.history_since,
+                                width=11)
+        since_entry.pack(side='left', padx=5)
+        ttk.Label(filter_frame, text="To:").pack(side='left')
+        until_entry = ttk.Entry(filter_frame, textvariable=self.history_until,
+                                width=11)
+        until_entry.pack(side='left', padx=5)
+        ttk.Label(filter_frame, text="(YYYY-MM-DD)").pack(side='left')
+
+        for entry in (search_entry, since_entry, until_entry):
+            entry.bind('<KeyRelease>', self.schedule_history_search)
+        type_combo.bind('<<ComboboxSelected>>', self.schedule_history_search)
+
         # History list with thumbnails
-        self.history_tree = ttk.Treeview(history_frame, columns=(
-            'Date', 'Type', 'Preview'), show='tree headings')
-        self.history_tree.heading('#0', text='Data')
+        tree_frame = ttk.Frame(history_frame)
+        tree_frame.pack(fill='both', expand=True, pady=10)
+
+        # Treeview can only show images in the tree column, so that
+        # column is the preview and the payload moves to a value column
+        self.history_tree = ttk.Treeview(tree_frame, columns=(
+            'Data', 'Date', 'Type'), show='tree headings',
+            style='History.Treeview')
+        self.history_tree.heading('#0', text='Preview')
+        self.history_tree.column('#0', width=qr_history.THUMBNAIL_SIZE + 30,
+                                 stretch=False)
+        self.history_tree.heading('Data', text='Data')
         self.history_tree.heading('Date', text='Date')
         self.history_tree.heading('Type', text='Type')
-        self.history_tree.pack(fill='both', expand=True, pady=10)
+        self.history_scrollbar = ttk.Scrollbar(
+            tree_frame, orient='vertical', command=self.history_tree.yview)
+        self.history_tree.configure(yscrollcommand=self.on_history_scroll)
+        self.history_scrollbar.pack(side='right', fill='y')
+        self.history_tree.pack(side='left', fill='both', expand=True)
+
+        self.history_count_label = ttk.Label(history_frame, text="")
+        self.history_count_label.pack(anchor='w')
+        self.reload_history_view()
 
         # History controls
         controls_frame = ttk.Frame(history_frame)
@@ -610,9 +786,15 @@ class ModernQRGenerator:
         data_type = self.detect_data_type(data)
         self.data_type_label.config(text=data_type)
 
-        # Generate preview in thread to avoid UI freeze
-        threading.Thread(target=self.generate_preview,
-                         args=(data,), daemon=True).start()
+        # Snapshot Tk state here, the worker thread must not touch Tk variables
+        error_correction = qr_render.error_correction_from_label(
+            self.error_correction.get())
+        style = self.current_style(
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=8, border=2, logo_path="")
+
+        # Coalesced on the preview worker to avoid UI freeze
+        self.preview_scheduler.submit(data, style, error_correction)
 
     def detect_data_type(self, data):
         """Detect the type of data for smart preview"""
@@ -627,66 +809,57 @@ class ModernQRGenerator:
         else:
             return "Text"
 
-    def generate_preview(self, data):
-        """Generate preview QR code"""
-        try:
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=8,
-                border=2,
-            )
-            qr.add_data(data)
-            qr.make(fit=True)
-
-            img = qr.make_image(fill_color=self.fill_color.get(),
-                                back_color=self.bg_color.get() if not self.transparent_bg.get() else None)
-
-            # Apply gradient if enabled
-            if self.use_gradient.get():
-                img = self.apply_gradient_effect(img)
-
-            # Resize for preview
-            img = img.resize((150, 150), Image.Resampling.LANCZOS)
-            photo = ImageTk.PhotoImage(img)
+    def current_style(self, **overrides):
+        """Snapshot the Tk style variables into a headless QRStyle"""
+        style = qr_render.QRStyle(
+            fill_color=self.fill_color.get(),
+            bg_color=self.bg_color.get(),
+            transparent_bg=self.transparent_bg.get(),
+            error_correction=qr_render.error_correction_from_label(
+                self.error_correction.get()),
+            border=self.border_size.get(),
+            use_gradient=self.use_gradient.get(),
+            gradient_start=self.gradient_start.get(),
+            gradient_end=self.gradient_end.get(),
+            gradient_mode=self.gradient_mode.get(),
+            module_shape=self.qr_shape.get(),
+            eye_pattern=self.eye_pattern.get(),
+            logo_path=self.logo_path.get(),
+            logo_shape=self.logo_shape.get(),
+            mask_pattern=None if self.mask_pattern.get() == "Auto"
+            else int(self.mask_pattern.get())
+        )
+        return style.with_options(**overrides)
 
-            # Update UI in main thread
-            self.root.after(0, lambda: self.update_preview_image(photo))
+    def generate_preview(self, data, style, error_correction):
+        """Render the preview and plan the saved code (runs on the preview worker)"""
+        try:
+            plan = qr_render.plan_encoding(data, error_correction)
+        except qrcode.exceptions.DataOverflowError:
+            plan = None
+        return qr_render.render_preview(data, style, size=150), plan
 
-        except Exception as e:
-            print(f"Preview generation error: {e}")
+    def deliver_preview(self, generation, result, latency):
+        """Hand a finished preview from the worker to the main thread"""
+        self.root.after(0, lambda: self.update_preview_image(
+            generation, *result, latency))
 
-    def update_preview_image(self, photo):
+    def update_preview_image(self, generation, img, plan, latency):
         """Update preview image in UI"""
+        # A newer request may have been queued after this one was posted
+        if not self.preview_scheduler.is_current(generation):
+            return
+        if not self.preview_label.winfo_exists():
+            return
+
+        photo = ImageTk.PhotoImage(img)
         self.preview_label.configure(image=photo)
         self.preview_label.image = photo
-
-    def apply_gradient_effect(self, img):
-        """Apply gradient effect to QR code"""
-        # Convert to numpy array for processing
-        img_array = np.array(img.convert('RGB'))
-
-        # Create gradient
-        height, width = img_array.shape[0], img_array.shape[1]
-        gradient = np.zeros((height, width, 3), dtype=np.uint8)
-
-        # Simple horizontal gradient
-        for i in range(width):
-            ratio = i / width
-            r = int((1 - ratio) * int(self.gradient_start.get()[1:3], 16) +
-                    ratio * int(self.gradient_end.get()[1:3], 16))
-            g = int((1 - ratio) * int(self.gradient_start.get()[3:5], 16) +
-                    ratio * int(self.gradient_end.get()[3:5], 16))
-            b = int((1 - ratio) * int(self.gradient_start.get()[5:7], 16) +
-                    ratio * int(self.gradient_end.get()[5:7], 16))
-
-            gradient[:, i] = [r, g, b]
-
-        # Apply gradient only to black pixels (QR code parts)
-        mask = img_array.mean(axis=2) < 128  # Black pixels
-        result = np.where(mask[:, :, None], gradient, img_array)
-
-        return Image.fromarray(result)
+        self.preview_latency_label.configure(
+            text=f"Rendered in {latency * 1000:.0f} ms")
+        self.preview_plan_label.configure(
+            text=qr_render.describe_plan(plan) if plan else
+            "Too long for this error correction level")
 
     def choose_fill_color(self):
         """Choose fill color for QR code"""
@@ -719,13 +892,19 @@ class ModernQRGenerator:
 
     def start_camera(self):
         """Start camera for QR scanning"""
+        if self.camera_active:
+            return
         try:
-            self.cap = cv2.VideoCapture(0)
-            if not self.cap.isOpened():
+            cap = cv2.VideoCapture(0)
+            if not cap.isOpened():
                 messagebox.showerror("Camera Error", "Could not access camera")
                 return
+            # Capture and decode run on the scanner's own threads
+            self.camera_scanner = qr_scan.CameraScanner(
+                cap, self.deliver_camera_frame,
+                decode_rate=max(1, self.scan_rate.get()))
             self.camera_active = True
-            self.update_camera_feed()
+            self.camera_scanner.start()
         except Exception as e:
             messagebox.showerror(
                 "Camera Error", f"Failed to start camera: {str(e)}")
@@ -733,44 +912,46 @@ class ModernQRGenerator:
     def stop_camera(self):
         """Stop camera"""
         self.camera_active = False
-        if self.cap:
-            self.cap.release()
-        self.camera_label.configure(text="Camera stopped")
+        if self.camera_scanner:
+            self.camera_scanner.stop()
+            self.camera_scanner = None
+        if self.camera_label.winfo_exists():
+            self.camera_label.configure(image='', text="Camera stopped")
+            self.camera_stats_label.configure(text="")
+
+    def deliver_camera_frame(self):
+        """Ask the main thread to show the scanner's newest frame"""
+        self.root.after(0, self.update_camera_feed)
 
     def update_camera_feed(self):
-        """Update camera feed for QR scanning"""
-        if self.camera_active and self.cap:
-            ret, frame = self.cap.read()
-            if ret:
-                # Convert to RGB and detect QR codes
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # QR code detection
-                detector = cv2.QRCodeDetector()
-                data, bbox, _ = detector.detectAndDecode(rgb_frame)
-
-                if bbox is not None:
-                    # Draw bounding box
-                    bbox = bbox.astype(int)
-                    for i in range(len(bbox)):
-                        cv2.line(rgb_frame, tuple(bbox[i][0]), tuple(bbox[(i+1) % len(bbox)][0]),
-                                 color=(255, 0, 0), thickness=2)
-
-                    if data:
-                        self.scan_result.delete('1.0', tk.END)
-                        self.scan_result.insert('1.0', f"Scanned: {data}")
-
-                # Convert to PhotoImage and update label
-                img = Image.fromarray(rgb_frame)
-                img = img.resize((400, 300), Image.Resampling.LANCZOS)
-                photo = ImageTk.PhotoImage(img)
-
-                self.camera_label.configure(image=photo)
-                self.camera_label.image = photo
-
-            # Continue updating
-            if self.camera_active:
-                self.root.after(10, self.update_camera_feed)
+        """Show the latest annotated camera frame and scan result"""
+        scanner = self.camera_scanner
+        if not self.camera_active or scanner is None:
+            return
+        frame = scanner.latest()
+        if frame is None or not self.camera_label.winfo_exists():
+            return
+
+        photo = ImageTk.PhotoImage(frame.image)
+        self.camera_label.configure(image=photo)
+        self.camera_label.image = photo
+        self.camera_stats_label.configure(
+            text=f"{frame.fps:.0f} FPS, decode {frame.latency * 1000:.0f} ms, "
+                 f"{len(frame.codes)} in view, {len(self.scan_results)} found")
+
+        if self.scan_results.add(frame.codes):
+            self.show_scan_results()
+
+    def show_scan_results(self):
+        """List every distinct code scanned so far"""
+        self.scan_result.delete('1.0', tk.END)
+        self.scan_result.insert('1.0', "\n".join(
+            f"Scanned: {data}" for data in self.scan_results))
+
+    def clear_scan_results(self):
+        """Forget the codes scanned so far"""
+        self.scan_results.clear()
+        self.scan_result.delete('1.0', tk.END)
 
     def scan_from_image(self):
         """Scan QR code from uploaded image"""
@@ -779,13 +960,15 @@ class ModernQRGenerator:
             filetypes=[("Image Files", "*.png *.jpg *.jpeg *.bmp")]
         )
         if path:
-            img = cv2.imread(path)
-            detector = cv2.QRCodeDetector()
-            data, bbox, _ = detector.detectAndDecode(img)
+            try:
+                codes = qr_scan.decode_image(path)
+            except ValueError as e:
+                messagebox.showerror("Scan Failed", str(e))
+                return
 
-            if data:
-                self.scan_result.delete('1.0', tk.END)
-                self.scan_result.insert('1.0', f"Scanned: {data}")
+            if codes:
+                self.scan_results.add(codes)
+                self.show_scan_results()
             else:
                 messagebox.showwarning(
                     "Scan Failed", "No QR code found in the image")
@@ -857,13 +1040,14 @@ END:VCARD"""
     def preview_csv_data(self, path):
         """Preview CSV data"""
         try:
+            # Only the first rows are needed, don't load the whole file
             with open(path, 'r', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
-                rows = list(reader)
+                rows = list(islice(reader, 5))
 
             preview_text = f"Columns: {', '.join(reader.fieldnames)}\n\n"
             preview_text += "First 5 rows:\n"
-            for i, row in enumerate(rows[:5]):
+            for i, row in enumerate(rows):
                 preview_text += f"{i+1}. {str(row)}\n"
 
             self.bulk_preview.delete('1.0', tk.END)
@@ -882,55 +1066,107 @@ END:VCARD"""
         if not output_dir:
             return
 
+        # Read Tk state here, the job runs on a background thread
+        options = {
+            "naming_template": self.naming_template.get(),
+            "workers": max(1, self.bulk_workers.get()),
+            "write_files": self.bulk_write_files.get(),
+            "zip_compression": self.bulk_zip_compression.get(),
+            "output_format": self.bulk_format.get(),
+            "png_preset": self.bulk_png_preset.get()
+        }
+        self.bulk_status_label.configure(text="Generating...")
+
+        threading.Thread(target=self.run_bulk_job,
+                         args=(self.bulk_file_path, output_dir, options),
+                         daemon=True).start()
+
+    def run_bulk_job(self, csv_path, output_dir, options):
+        """Run a bulk job off the Tk thread and report back on it"""
+        def progress(done):
+            if done % 100 == 0:
+                self.root.after(0, lambda: self.set_bulk_status(
+                    f"Generated {done} rows..."))
+
         try:
-            with open(self.bulk_file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
+            report = qr_bulk.generate_bulk(
+                qr_bulk.iter_rows(csv_path), output_dir, progress=progress,
+                **options)
+        except Exception as e:
+            # Bind the message now: e is unset once the except block ends
+            msg = f"Failed to process bulk generation: {e}"
+            self.root.after(0, lambda msg=msg: self.show_bulk_error(msg))
+            return
 
-            success_count = 0
-            for i, row in enumerate(rows):
-                try:
-                    # Use first column as data, or customize as needed
-                    data = list(row.values())[0]
-
-                    qr = qrcode.QRCode(
-                        version=1,
-                        error_correction=qrcode.constants.ERROR_CORRECT_H,
-                        box_size=10,
-                        border=4,
-                    )
-                    qr.add_data(data)
-                    qr.make(fit=True)
-
-                    img = qr.make_image(fill_color="black", back_color="white")
-
-                    # Generate filename from template
-                    filename = self.naming_template.get().format(
-                        name=row.get('name', f'qr_{i+1:03d}'),
-                        date=datetime.now().strftime("%Y%m%d"),
-                        index=i+1
-                    ) + ".png"
-
-                    filepath = os.path.join(output_dir, filename)
-                    img.save(filepath)
-                    success_count += 1
+        self.root.after(0, lambda: self.show_bulk_report(report))
+
+    def set_bulk_status(self, text):
+        """Show text under the bulk buttons, if the bulk tab is still open"""
+        if self.bulk_status_label.winfo_exists():
+            self.bulk_status_label.configure(text=text)
+
+    def show_bulk_error(self, message):
+        """Report a failed bulk job or label sheet export"""
+        self.set_bulk_status("Failed")
+        messagebox.showerror("Error", message)
+
+    def show_bulk_report(self, report):
+        """Show the summary of a finished bulk job"""
+        self.set_bulk_status(f"{report.row_count} rows in {report.elapsed:.1f}s "
+                             f"({report.rows_per_second:.0f} rows/s)")
+
+        message = (f"Successfully generated {report.success_count} QR codes!\n"
+                   f"ZIP file created: {os.path.basename(report.zip_path)}")
+        if report.duplicates:
+            message += (f"\n{report.duplicates} repeated rows reused an earlier "
+                        f"code ({report.linked} files hard-linked)")
+        if report.errors:
+            failed = "\n".join(f"Row {row}: {error}"
+                               for row, error in report.errors[:10])
+            message += f"\n\n{len(report.errors)} rows failed:\n{failed}"
+        messagebox.showinfo("Bulk Generation Complete", message)
+
+    def export_label_sheet(self):
+        """Lay out the selected CSV on multi-page PDF label sheets"""
+        if not hasattr(self, 'bulk_file_path'):
+            messagebox.showerror("Error", "Please select a CSV file first!")
+            return
 
-                except Exception as e:
-                    print(f"Failed to generate QR for row {i+1}: {str(e)}")
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=".pdf",
+            filetypes=[("PDF files", "*.pdf")],
+            title="Save Label Sheet"
+        )
+        if not save_path:
+            return
 
-            # Create ZIP file
-            zip_path = os.path.join(output_dir, "qr_codes.zip")
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for file in os.listdir(output_dir):
-                    if file.endswith('.png'):
-                        zipf.write(os.path.join(output_dir, file), file)
+        layout = qr_export.LabelSheetLayout(
+            columns=max(1, self.sheet_columns.get()),
+            rows=max(1, self.sheet_rows.get()))
+        csv_path = self.bulk_file_path
+        self.bulk_status_label.configure(text="Laying out labels...")
+
+        def run():
+            try:
+                report = qr_bulk.generate_label_sheet(
+                    qr_bulk.iter_rows(csv_path), save_path, layout=layout)
+            except Exception as e:
+                msg = f"Failed to create label sheet: {e}"
+                self.root.after(0, lambda msg=msg: self.show_bulk_error(msg))
+                return
+            self.root.after(0, lambda: self.show_label_sheet_report(
+                report, save_path))
 
-            messagebox.showinfo("Bulk Generation Complete",
-                                f"Successfully generated {success_count} QR codes!\nZIP file created: qr_codes.zip")
+        threading.Thread(target=run, daemon=True).start()
 
-        except Exception as e:
-            messagebox.showerror(
-                "Error", f"Failed to process bulk generation: {str(e)}")
+    def show_label_sheet_report(self, report, save_path):
+        """Show the summary of a finished label sheet export"""
+        self.set_bulk_status(
+            f"{report.success_count} labels in {report.elapsed:.1f}s")
+        message = f"Label sheet saved to {save_path}"
+        if report.errors:
+            message += f"\n{len(report.errors)} rows could not be encoded"
+        messagebox.showinfo("Success", message)
 
     def generate_secure_qr(self):
         """Generate password-protected QR"""
@@ -1025,10 +1261,10 @@ END:VCARD"""
 
         if save_path:
             try:
-                # Create SVG QR code
-                factory = qrcode.image.svg.SvgImage
-                img = qrcode.make(data, image_factory=factory)
-                img.save(save_path)
+                # Create SVG QR code with the current colors and gradient
+                svg_bytes = qr_export.render_svg(data, self.current_style())
+                with open(save_path, 'wb') as f:
+                    f.write(svg_bytes)
                 messagebox.showinfo("Success", f"SVG saved to {save_path}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to save SVG: {str(e)}")
@@ -1048,30 +1284,10 @@ END:VCARD"""
 
         if save_path:
             try:
-                # Generate QR code
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_H,
-                    box_size=10,
-                    border=4,
-                )
-                qr.add_data(data)
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-
-                # Save temporary image
-                temp_img = "temp_qr.png"
-                img.save(temp_img)
-
-                # Create PDF
-                c = canvas.Canvas(save_path, pagesize=letter)
-                c.drawImage(temp_img, 100, 500, width=200, height=200)
-                c.setFont("Helvetica", 12)
-                c.drawString(100, 480, f"QR Code: {data[:50]}...")
-                c.save()
-
-                # Clean up
-                os.remove(temp_img)
+                pdf_bytes = qr_export.render_pdf(data, qr_render.QRStyle(
+                    fill_color="black", bg_color="white"))
+                with open(save_path, 'wb') as f:
+                    f.write(pdf_bytes)
                 messagebox.showinfo("Success", f"PDF saved to {save_path}")
 
             except Exception as e:
@@ -1092,16 +1308,12 @@ END:VCARD"""
 
         if save_path:
             try:
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_H,
+                img = qr_render.render_image(data, qr_render.QRStyle(
+                    fill_color="black", bg_color="white",
                     box_size=20,  # Larger for high resolution
-                    border=8,
-                )
-                qr.add_data(data)
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-                img.save(save_path, dpi=(300, 300))  # High DPI
+                    border=8))
+                qr_render.save_image(img, save_path, self.png_preset.get(),
+                                     dpi=(300, 300))  # High DPI
                 messagebox.showinfo(
                     "Success", f"High-res QR saved to {save_path}")
             except Exception as e:
@@ -1116,51 +1328,14 @@ END:VCARD"""
             return
 
         try:
-            # Map error correction
-            error_correction_map = {
-                "L (Low)": qrcode.constants.ERROR_CORRECT_L,
-                "M (Medium)": qrcode.constants.ERROR_CORRECT_M,
-                "Q (Quartile)": qrcode.constants.ERROR_CORRECT_Q,
-                "H (High)": qrcode.constants.ERROR_CORRECT_H
-            }
-
-            ec_level = error_correction_map.get(
-                self.error_correction.get(), qrcode.constants.ERROR_CORRECT_H)
-
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=ec_level,
-                box_size=10,
-                border=self.border_size.get(),
-            )
-            qr.add_data(data)
-            qr.make(fit=True)
-
-            img = qr.make_image(fill_color=self.fill_color.get(),
-                                back_color=self.bg_color.get() if not self.transparent_bg.get() else None)
-
-            # Apply gradient if enabled
-            if self.use_gradient.get():
-                img = self.apply_gradient_effect(img)
+            style = self.current_style()
+            img = qr_render.render_base_image(data, style)
 
             # Add logo if selected
-            if self.logo_path.get():
+            if style.logo_path:
                 try:
-                    logo = Image.open(self.logo_path.get())
-                    # Resize logo to 20% of QR code size
-                    qr_size = min(img.size) // 5
-                    logo = logo.resize((qr_size, qr_size),
-                                       Image.Resampling.LANCZOS)
-
-                    # Create circular mask for logo
-                    mask = Image.new('L', (qr_size, qr_size), 0)
-                    draw = ImageDraw.Draw(mask)
-                    draw.ellipse((0, 0, qr_size, qr_size), fill=255)
-
-                    # Paste logo with mask
-                    pos = ((img.size[0] - qr_size) // 2,
-                           (img.size[1] - qr_size) // 2)
-                    img.paste(logo, pos, mask)
+                    img = qr_render.add_logo(img, style.logo_path,
+                                             style.logo_shape)
                 except Exception as e:
                     messagebox.showwarning(
                         "Logo Error", f"Could not add logo: {str(e)}")
@@ -1173,7 +1348,8 @@ END:VCARD"""
             )
 
             if save_path:
-                img.save(save_path)
+                qr_render.save_image(img, save_path, self.png_preset.get(),
+                                     background=style.bg_color)
                 self.add_to_history(data, save_path)
                 messagebox.showinfo(
                     "Success", f"QR code saved successfully!\nLocation: {save_path}")
@@ -1223,16 +1399,112 @@ END:VCARD"""
 
     def add_to_history(self, data, filepath):
         """Add generation to history"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        history_entry = {
-            "timestamp": timestamp,
-            "data": data,
-            "filepath": filepath,
-            "type": self.detect_data_type(data)
+        try:
+            self.history.add(data, filepath, self.detect_data_type(data))
+        except Exception as e:
+            print(f"Could not save history: {e}")
+
+    def history_filters(self):
+        """Current search box and filter values as HistoryStore arguments"""
+        def date_or_none(text):
+            text = text.strip()
+            try:
+                datetime.strptime(text, "%Y-%m-%d")
+            except ValueError:
+                return None  # ignore half-typed dates
+            return text
+
+        entry_type = self.history_type_filter.get()
+        return {
+            "query": self.history_query.get(),
+            "entry_type": None if entry_type == "All" else entry_type,
+            "since": date_or_none(self.history_since.get()),
+            "until": date_or_none(self.history_until.get())
         }
 
-        self.history_data.append(history_entry)
-        self.save_history()
+    def schedule_history_search(self, event=None):
+        """Refresh the history list shortly after the last keystroke"""
+        if self.history_search_job:
+            self.root.after_cancel(self.history_search_job)
+        self.history_search_job = self.root.after(150, self.reload_history_view)
+
+    def reload_history_view(self):
+        """Empty the history list and show the newest page again"""
+        self.history_search_job = None
+        if not self.history_tree.winfo_exists():
+            return
+        self.history_tree.delete(*self.history_tree.get_children())
+        self.history_last_entry = None
+        self.history_exhausted = False
+        self.history_thumbnails.clear()
+        self.load_history_page()
+
+        count = self.history.count(limit=qr_history.COUNT_LIMIT,
+                                   **self.history_filters())
+        more = "+" if count >= qr_history.COUNT_LIMIT else ""
+        self.history_count_label.configure(text=f"{count}{more} entries")
+
+    def load_history_page(self):
+        """Append the next page of older entries to the history list"""
+        self.history_page_pending = False
+        if self.history_exhausted or not self.history_tree.winfo_exists():
+            return
+        entries = self.history.page(before=self.history_last_entry,
+                                    **self.history_filters())
+        if len(entries) < qr_history.PAGE_SIZE:
+            self.history_exhausted = True
+        for entry in entries:
+            self.history_tree.insert(
+                '', 'end', iid=str(entry["id"]),
+                values=(entry["data"].replace("\n", " ")[:80],
+                        entry["timestamp"], entry["type"]))
+        if entries:
+            self.history_last_entry = entries[-1]
+
+    def on_history_scroll(self, first, last):
+        """Scrollbar callback that loads more rows near the bottom"""
+        self.history_scrollbar.set(first, last)
+        self.request_history_thumbnails(first, last)
+        if (float(last) > 0.9 and not self.history_exhausted and
+                not self.history_page_pending):
+            # Let the Treeview finish its current redraw first
+            self.history_page_pending = True
+            self.root.after_idle(self.load_history_page)
+
+    def request_history_thumbnails(self, first, last):
+        """Ask the thumbnail worker for the rows between two scroll fractions"""
+        rows = self.history_tree.get_children()
+        start = int(float(first) * len(rows))
+        end = min(len(rows), int(float(last) * len(rows)) + 1)
+        missing = [iid for iid in rows[start:end]
+                   if iid not in self.history_thumbnails]
+        if missing:
+            self.thumbnail_loader.request(missing)
+
+    def render_history_thumbnail(self, iid):
+        """Thumbnail for a history row (runs on the worker thread)"""
+        entry = self.history.get(int(iid))
+        return self.thumbnail_cache.get(entry["data"]) if entry else None
+
+    def deliver_history_thumbnail(self, iid, img):
+        """Called from the thumbnail worker with a finished thumbnail"""
+        self.root.after(0, lambda: self.show_history_thumbnail(iid, img))
+
+    def show_history_thumbnail(self, iid, img):
+        """Put a thumbnail on its row if the row is still listed"""
+        if not self.history_tree.winfo_exists() or not self.history_tree.exists(iid):
+            return
+        photo = ImageTk.PhotoImage(img) if img is not None else None
+        # None marks rows that can't be rendered so they aren't asked for again
+        self.history_thumbnails[iid] = photo
+        if photo is not None:
+            self.history_tree.item(iid, image=photo)
+
+        # Drop the images furthest back in scrolling; they come back from disk
+        while len(self.history_thumbnails) > self.history_thumbnail_limit:
+            old_iid, _ = self.history_thumbnails.popitem(last=False)
+            if self.history_tree.exists(old_iid):
+                self.history_tree.item(old_iid, image='')
 
     def regenerate_from_history(self):
         """Regenerate selected QR code from history"""
@@ -1248,8 +1520,10 @@ END:VCARD"""
     def clear_history(self):
         """Clear generation history"""
         if messagebox.askyesno("Confirm", "Are you sure you want to clear all history?"):
-            self.history_data.clear()
-            self.save_history()
+            self.history.clear()
+            # Thumbnails are the payloads too, so they go with the history
+            self.thumbnail_cache.clear()
+            self.reload_history_view()
 
     def export_history(self):
         """Export history to file"""
@@ -1260,30 +1534,20 @@ END:VCARD"""
         )
         if save_path:
             try:
-                with open(save_path, 'w') as f:
-                    json.dump(self.history_data, f, indent=2)
+                self.history.export_json(save_path)
                 messagebox.showinfo(
                     "Success", "History exported successfully!")
             except Exception as e:
                 messagebox.showerror(
                     "Error", f"Failed to export history: {str(e)}")
 
-    def save_history(self):
-        """Save history to file"""
-        try:
-            with open("qr_history.json", "w") as f:
-                json.dump(self.history_data, f)
-        except:
-            pass
-
     def load_history(self):
-        """Load history from file"""
+        """Open the history store, importing an old qr_history.json once"""
+        self.history = qr_history.HistoryStore()
         try:
-            if os.path.exists("qr_history.json"):
-                with open("qr_history.json", "r") as f:
-                    self.history_data = json.load(f)
-        except:
-            self.history_data = []
+            self.history.import_legacy()
+        except Exception as e:
+            print(f"Could not import old history: {e}")
 
     def save_preferences(self):
         """Save user preferences"""
@@ -1321,11 +1585,28 @@ END:VCARD"""
             self.user_preferences = {}
 
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="harzad qr generator")
+    subparsers = parser.add_subparsers(dest="command")
+    qr_bulk.build_arg_parser(subparsers.add_parser(
+        "bulk", help="generate QR codes from a CSV file without the GUI"))
+    qr_bulk.build_labels_arg_parser(subparsers.add_parser(
+        "labels", help="lay out QR codes from a CSV file on PDF label sheets"))
+    qr_scan.build_verify_arg_parser(subparsers.add_parser(
+        "verify", help="scan bulk output and check it against the source CSV"))
+    args = parser.parse_args(argv)
+
+    if args.command == "bulk":
+        return qr_bulk.run_cli(args)
+    if args.command == "labels":
+        return qr_bulk.run_labels_cli(args)
+    if args.command == "verify":
+        return qr_scan.run_verify_cli(args)
+
     root = tk.Tk()
     app = ModernQRGenerator(root)
     root.mainloop()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,445 @@
+"""Generation history backed by SQLite.
+
+Each generated code is one INSERT in its own transaction, so adding an
+entry costs the same with ten rows or a million, and a crash can never
+leave a half-written history behind. Reads are paged newest first using
+the id, so the history tab only ever loads the rows it shows. Entries
+are appended as they are made, so id order is chronological order.
+
+Search goes through an FTS5 inverted index over data, type and filepath
+that is updated in the same transaction as every insert. FTS5 walks its
+matches in id order too, so a page of results stops after PAGE_SIZE
+hits instead of sorting every match.
+
+Thumbnails for the history tab live in a size-capped directory of PNGs
+named by a hash of the payload, rendered in the background only for the
+rows the user actually scrolls to.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from PIL import Image
+
+import qr_render
+
+
+HISTORY_DB = "qr_history.db"
+
+# Written by older versions; imported once and then renamed
+LEGACY_HISTORY_JSON = "qr_history.json"
+
+# Same format the JSON history used; sorts chronologically as text
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+PAGE_SIZE = 100
+
+# count() stops here so a one-letter search doesn't count every entry
+COUNT_LIMIT = 10000
+
+# Types detect_data_type assigns, offered as history filters
+ENTRY_TYPES = ("URL", "Email", "WiFi", "Contact", "Text")
+
+THUMBNAIL_DIR = "qr_thumbnails"
+THUMBNAIL_SIZE = 40
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
+
+# History doesn't record styles, so thumbnails are plain codes with a
+# thin quiet zone to make the most of the pixels
+THUMBNAIL_STYLE = qr_render.DEFAULT_STYLE.with_options(border=1)
+
+# Part of every thumbnail's hash; bump it when THUMBNAIL_STYLE or the
+# rendering changes so old files are never shown again
+THUMBNAIL_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    filepath TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS history_by_timestamp ON history (timestamp);
+CREATE INDEX IF NOT EXISTS history_by_type ON history (type);
+"""
+
+# External-content index: stores only the inverted lists, not the text.
+# prefix='1 2 3' adds short-prefix lists so the first letters typed are fast.
+_FTS_SCHEMA = """
+DROP INDEX IF EXISTS history_timestamp;
+DROP INDEX IF EXISTS history_type;
+CREATE VIRTUAL TABLE history_fts USING fts5 (
+    data, type, filepath,
+    content='history', content_rowid='id',
+    prefix='1 2 3', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+_COLUMNS = "id, timestamp, type, data, filepath"
+
+
+class HistoryStore:
+    """Thread-safe store of history entries.
+
+    Entries are dicts with id, timestamp, type, data and filepath keys,
+    the same shape the JSON history used plus a stable id.
+    """
+
+    def __init__(self, path=HISTORY_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WAL keeps readers off the writer's back and makes commits cheap
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+            has_index = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone()
+            if not has_index:
+                # Databases from before search existed get indexed once
+                # (and lose their old timestamp-ordered indexes)
+                self._conn.executescript(_FTS_SCHEMA)
+                self._conn.execute(
+                    "INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+    def add(self, data, filepath="", entry_type="Text", timestamp=None):
+        """Append one entry and return its id"""
+        timestamp = timestamp or datetime.now().strftime(TIMESTAMP_FORMAT)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO history (timestamp, type, data, filepath) "
+                "VALUES (?, ?, ?, ?)", (timestamp, entry_type, data, filepath))
+            self._conn.execute(
+                "INSERT INTO history_fts (rowid, data, type, filepath) "
+                "VALUES (?, ?, ?, ?)", (cursor.lastrowid, data, entry_type, filepath))
+            return cursor.lastrowid
+
+    def add_many(self, entries):
+        """Append entry dicts in a single transaction, returning the count"""
+        rows = [(entry.get("timestamp") or datetime.now().strftime(TIMESTAMP_FORMAT),
+                 entry.get("type") or "Text", entry.get("data") or "",
+                 entry.get("filepath") or "")
+                for entry in entries]
+        with self._lock, self._conn:
+            first = self._conn.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM history").fetchone()[0]
+            self._conn.executemany(
+                "INSERT INTO history (timestamp, type, data, filepath) "
+                "VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute(
+                "INSERT INTO history_fts (rowid, data, type, filepath) "
+                "SELECT id, data, type, filepath FROM history WHERE id >= ?",
+                (first,))
+        return len(rows)
+
+    def get(self, entry_id):
+        """Return one entry by id, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM history WHERE id = ?",
+                (entry_id,)).fetchone()
+        return dict(row) if row else None
+
+    def count(self, entry_type=None, query="", since=None, until=None,
+              limit=None):
+        """Number of entries matching the same filters as page().
+
+        With a limit, counting stops there and limit is returned for
+        anything larger.
+        """
+        source, key, clauses, params = _filters(entry_type, query, since, until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT 1 FROM {source} {where}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT COUNT(*) FROM ({sql})", params).fetchone()
+        return row[0]
+
+    def page(self, before=None, limit=PAGE_SIZE, entry_type=None, query="",
+             since=None, until=None):
+        """Return up to limit entries, newest first.
+
+        before is the entry dict the previous page ended with (or None for
+        the first page). Paging by key instead of OFFSET keeps every page
+        an index seek, however deep the user scrolls.
+
+        query keeps entries containing a word starting with each word
+        typed, in data, type or filepath. since and until are dates
+        ('YYYY-MM-DD') or full timestamps and both ends are inclusive.
+        """
+        source, key, clauses, params = _filters(entry_type, query, since, until)
+        if before is not None:
+            clauses.append(f"{key} < ?")
+            params.append(before["id"])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        columns = ", ".join(f"h.{name}" for name in _COLUMNS.split(", "))
+
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM {source} {where} "
+                f"ORDER BY {key} DESC LIMIT ?", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def iter_all(self, batch_size=1000):
+        """Yield every entry, oldest first, without loading them all at once"""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT {_COLUMNS} FROM history WHERE id > ? "
+                    "ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]["id"]
+
+    def clear(self):
+        """Delete every entry"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM history")
+            self._conn.execute(
+                "INSERT INTO history_fts (history_fts) VALUES ('delete-all')")
+
+    def export_json(self, path):
+        """Write all entries to a JSON file in the legacy list format"""
+        with open(path, "w") as f:
+            f.write("[")
+            for i, entry in enumerate(self.iter_all()):
+                entry.pop("id")
+                f.write((",\n  " if i else "\n  ") + json.dumps(entry))
+            f.write("\n]\n")
+
+    def import_legacy(self, path=LEGACY_HISTORY_JSON):
+        """Move a qr_history.json from older versions into the store.
+
+        The file is renamed afterwards so it is only imported once.
+        Returns the number of entries imported.
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as f:
+            entries = json.load(f)
+        # Keep id order chronological
+        entries.sort(key=lambda entry: entry.get("timestamp") or "")
+        count = self.add_many(entries)
+        os.replace(path, path + ".imported")
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def match_expression(query):
+    """Turn typed text into an FTS5 query matching every word as a prefix"""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", query))
+
+
+def _filters(entry_type=None, query="", since=None, until=None):
+    """Build the query shared by page() and count().
+
+    Returns (FROM clause, id column, WHERE clauses, parameters). With a
+    search query the FTS table drives the loop and the id column is its
+    rowid, so FTS5 sees the id bounds and the ORDER BY directly.
+    """
+    match = match_expression(query or "")
+    if match:
+        # CROSS JOIN pins the FTS table as the outer loop
+        source = "history_fts CROSS JOIN history h ON h.id = history_fts.rowid"
+        key = "history_fts.rowid"
+        clauses, params = ["history_fts MATCH ?"], [match]
+    else:
+        source, key = "history h", "h.id"
+        clauses, params = [], []
+
+    if entry_type:
+        clauses.append("h.type = ?")
+        params.append(entry_type)
+    if since:
+        # The id bound is exact whatever the insert order and lets both
+        # tables skip straight to the range; the timestamp test stays
+        clauses.append(f"{key} >= (SELECT COALESCE(MIN(id), 1 << 62) "
+                       "FROM history WHERE timestamp >= ?)")
+        clauses.append("h.timestamp >= ?")
+        params.extend((since, since))
+    if until:
+        # A bare date includes the whole day
+        until = until + " 23:59:59" if len(until) == 10 else until
+        clauses.append(f"{key} <= (SELECT COALESCE(MAX(id), 0) FROM history "
+                       "WHERE timestamp <= ?)")
+        clauses.append("h.timestamp <= ?")
+        params.extend((until, until))
+    return source, key, clauses, params
+
+
+class ThumbnailCache:
+    """Content-addressed PNG thumbnails of payloads, kept on disk.
+
+    A file is named by a hash of the payload and the thumbnail size, so
+    identical payloads share one file, a file never goes stale and the
+    directory is reused from session to session. Reading a thumbnail
+    bumps its mtime; once the files add up to more than max_bytes the
+    least recently used ones are deleted.
+    """
+
+    def __init__(self, directory=THUMBNAIL_DIR, size=THUMBNAIL_SIZE,
+                 max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._files = None  # path -> bytes, least recently used first
+        self._lock = threading.Lock()
+
+    def path(self, data):
+        """Where the thumbnail for data is (or would be) stored"""
+        digest = hashlib.sha256(
+            f"{THUMBNAIL_VERSION}:{self.size}:{data}".encode(
+                "utf-8", "surrogatepass")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".png")
+
+    def get(self, data):
+        """Return the thumbnail as a PIL image, rendering it on a miss"""
+        path = self.path(data)
+        with self._lock:
+            self._load_index()
+            if path in self._files:
+                try:
+                    img = Image.open(path)
+                    img.load()
+                    os.utime(path)
+                except OSError:
+                    # Deleted or truncated behind our back: render again
+                    self._bytes -= self._files.pop(path)
+                else:
+                    self._files.move_to_end(path)
+                    self.hits += 1
+                    return img
+            self.misses += 1
+
+        img = qr_render.render_preview(data, THUMBNAIL_STYLE, self.size)
+        png = qr_render.image_to_png_bytes(img, "smallest")
+
+        with self._lock:
+            if path not in self._files:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename so a crash never leaves half a PNG
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(png)
+                os.replace(temp_path, path)
+                self._files[path] = len(png)
+                self._bytes += len(png)
+            self._evict()
+        return img
+
+    def clear(self):
+        """Delete every cached thumbnail"""
+        with self._lock:
+            self._load_index()
+            for path in self._files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._files.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return hit/miss counters and disk use"""
+        with self._lock:
+            self._load_index()
+            return {"hits": self.hits, "misses": self.misses,
+                    "files": len(self._files), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
+
+    def _load_index(self):
+        """Scan the directory once, oldest use first (caller holds the lock)"""
+        if self._files is not None:
+            return
+        found = []
+        if os.path.isdir(self.directory):
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".png"):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        found.sort()
+        self._files = OrderedDict((path, size) for _, path, size in found)
+        self._bytes = sum(self._files.values())
+        self._evict()
+
+    def _evict(self):
+        """Delete least recently used files until under budget (caller holds the lock)"""
+        while self._bytes > self.max_bytes and self._files:
+            path, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ThumbnailLoader:
+    """Background worker that renders thumbnails for the rows in view.
+
+    request() never blocks and replaces whatever was asked for before,
+    so scrolling quickly past rows doesn't queue them up: the worker
+    finishes the thumbnail it is on and moves to the newest rows.
+    Results go to deliver(key, image) from the worker thread; image is
+    None if the key couldn't be rendered.
+    """
+
+    def __init__(self, render, deliver):
+        self._render = render
+        self._deliver = deliver
+        self._cond = threading.Condition()
+        self._pending = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, keys):
+        """Render these keys next, in order, dropping earlier requests"""
+        with self._cond:
+            self._pending = list(reversed(keys))
+            self._cond.notify()
+
+    def stop(self):
+        """Stop the worker thread, dropping anything not yet rendered"""
+        with self._cond:
+            self._stopped = True
+            self._pending = []
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                key = self._pending.pop()
+
+            try:
+                img = self._render(key)
+            except Exception as e:
+                print(f"Thumbnail error: {e}")
+                img = None
+            self._deliver(key, img)
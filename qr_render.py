@@ -0,0 +1,1105 @@
+"""Headless QR rendering core.
+
+Everything in here works on plain values (payload + QRStyle) and returns
+PIL images or encoded bytes, so it can be used by the Tk GUI, bulk jobs and
+servers alike without a display.
+"""
+import qrcode
+import qrcode.util
+from PIL import Image, ImageDraw, ImageColor
+import numpy as np
+from bisect import bisect_left
+from io import BytesIO
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass, replace
+import functools
+import os
+import threading
+import time
+
+
+# Directions supported by the gradient fill
+GRADIENT_MODES = ("horizontal", "vertical", "diagonal", "radial")
+
+# Shapes for the data modules and for the three finder patterns ("eyes")
+MODULE_SHAPES = ("squares", "dots", "rounded", "circles")
+EYE_PATTERNS = ("default", "circle", "rounded", "diamond")
+
+# Shape stamps are drawn this many times larger, then box-filtered down
+STAMP_SUPERSAMPLE = 4
+
+# Masks a logo can be cut to before it is pasted on a code
+LOGO_SHAPES = ("circle", "rounded", "square")
+
+# Error correction levels keyed by their single-letter name
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H
+}
+
+
+def error_correction_from_label(label, default=qrcode.constants.ERROR_CORRECT_H):
+    """Map a label such as 'H (High)' or 'm' to a qrcode constant"""
+    if isinstance(label, int):
+        return label
+    if not label:
+        return default
+    return ERROR_CORRECTION_LEVELS.get(label.strip()[:1].upper(), default)
+
+
+@dataclass(frozen=True)
+class QRStyle:
+    """Everything that affects how a payload is drawn"""
+    fill_color: str = "#000000"
+    bg_color: str = "#FFFFFF"
+    transparent_bg: bool = False
+    error_correction: int = qrcode.constants.ERROR_CORRECT_H
+    box_size: int = 10
+    border: int = 4
+    use_gradient: bool = False
+    gradient_start: str = "#000000"
+    gradient_end: str = "#000000"
+    gradient_mode: str = "horizontal"
+    module_shape: str = "squares"
+    eye_pattern: str = "default"
+    logo_path: str = ""
+    logo_shape: str = "circle"
+    mask_pattern: int = None  # 0-7 pins the data mask; None picks the best
+
+    def with_options(self, **changes):
+        """Return a copy of this style with some fields replaced"""
+        return replace(self, **changes)
+
+    @property
+    def shaped(self):
+        """True if modules or eyes are drawn as anything but plain squares"""
+        return self.module_shape != "squares" or self.eye_pattern != "default"
+
+
+DEFAULT_STYLE = QRStyle()
+
+
+def parse_color(color):
+    """Convert any PIL color string ('#rrggbb', 'black', ...) to (r, g, b)"""
+    return ImageColor.getrgb(color)[:3]
+
+
+# Result of encoding a payload, nothing about looks. matrix is the module
+# grid as a read-only boolean array (no border).
+EncodedQR = namedtuple("EncodedQR", ["version", "matrix", "plan",
+                                     "mask_pattern"])
+
+# How a payload is split into segments and the smallest version holding
+# them. segments is a tuple of (mode, bytes) using qrcode.util's modes.
+EncodingPlan = namedtuple("EncodingPlan", ["version", "segments", "bits"])
+
+MODE_NAMES = {
+    qrcode.util.MODE_NUMBER: "numeric",
+    qrcode.util.MODE_ALPHA_NUM: "alphanumeric",
+    qrcode.util.MODE_8BIT_BYTE: "byte"
+}
+
+# Versions sharing the same character count field widths
+VERSION_CLASSES = ((1, 9), (10, 26), (27, 40))
+
+# The eight standard data masks as functions of (row, column) arrays
+MASK_FUNCTIONS = (
+    lambda i, j: (i + j) % 2 == 0,
+    lambda i, j: i % 2 == 0,
+    lambda i, j: j % 3 == 0,
+    lambda i, j: (i + j) % 3 == 0,
+    lambda i, j: (i // 2 + j // 3) % 2 == 0,
+    lambda i, j: (i * j) % 2 + (i * j) % 3 == 0,
+    lambda i, j: ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+    lambda i, j: ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+)
+
+# Dark:light 1:1:3:1:1 next to four light modules, as 11-bit windows
+FINDER_LIKE_PATTERNS = (0b10111010000, 0b00001011101)
+
+
+class MatrixCache:
+    """Thread-safe LRU cache of encoded QR matrices.
+
+    Keyed by (payload, error correction level, pinned mask). Box size,
+    border and colors don't change the module matrix, so preview, generate
+    and the exporters can all share one entry for the same text.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, data, error_correction, mask_pattern=None):
+        """Return the EncodedQR for data, encoding it on a miss"""
+        key = (data, error_correction, mask_pattern)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+
+        # Encode outside the lock so a slow payload doesn't block other threads
+        encoded = encode(data, error_correction, mask_pattern)
+
+        with self._lock:
+            self._entries[key] = encoded
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "maxsize": self.maxsize}
+
+
+def _segment_modes(data, count_bits):
+    """Cheapest mode for every byte of data, for one version class.
+
+    Dynamic programming over (byte, mode) in sixths of a bit: a numeric
+    digit costs 10/3 bits, an alphanumeric character 11/2, a byte 8, and
+    starting a segment costs its mode and count headers. Each step keeps
+    the cheapest way to be in every mode after that byte.
+    """
+    numeric, alphanumeric, byte = (qrcode.util.MODE_NUMBER,
+                                   qrcode.util.MODE_ALPHA_NUM,
+                                   qrcode.util.MODE_8BIT_BYTE)
+    modes = (numeric, alphanumeric, byte)
+    char_costs = (20, 33, 48)
+    head_costs = [(4 + count_bits[mode]) * 6 for mode in modes]
+    alpha_chars = set(qrcode.util.ALPHA_NUM)
+    infinity = float("inf")
+
+    costs = head_costs
+    choices = []
+    for char in data:
+        fits = (48 <= char <= 57, char in alpha_chars, True)
+        encoded = [costs[m] + char_costs[m] if fits[m] else infinity
+                   for m in range(3)]
+        step = list(encoded)
+        # choice[m]: mode of this byte when the next byte is in mode m
+        choice = [m if fits[m] else None for m in range(3)]
+        for m in range(3):
+            for previous in range(3):
+                if not fits[previous]:
+                    continue
+                # Round up to whole bits when a segment ends
+                switched = -(-encoded[previous] // 6) * 6 + head_costs[m]
+                if switched < step[m]:
+                    step[m] = switched
+                    choice[m] = previous
+        choices.append(choice)
+        costs = step
+
+    mode = min(range(3), key=costs.__getitem__)
+    result = []
+    for choice in reversed(choices):
+        mode = choice[mode]
+        result.append(modes[mode])
+    result.reverse()
+    return result
+
+
+def _segment_bits(mode, length, count_bits):
+    """Exact size in bits of one segment including its headers"""
+    if mode == qrcode.util.MODE_NUMBER:
+        body = 10 * (length // 3) + (0, 4, 7)[length % 3]
+    elif mode == qrcode.util.MODE_ALPHA_NUM:
+        body = 11 * (length // 2) + 6 * (length % 2)
+    else:
+        body = 8 * length
+    return 4 + count_bits[mode] + body
+
+
+def plan_encoding(data, error_correction=qrcode.constants.ERROR_CORRECT_H):
+    """Split data into optimal segments and pick the smallest version.
+
+    Count fields get wider at versions 10 and 27, so the split is solved
+    for each range of versions in turn, smallest first, and the version
+    comes straight from the capacity table instead of trying one version
+    after another. Raises qrcode's DataOverflowError if nothing fits.
+    """
+    raw = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+    capacities = qrcode.util.BIT_LIMIT_TABLE[error_correction]
+
+    for first, last in VERSION_CLASSES:
+        # Even all-numeric data needs 10 bits per 3 bytes
+        if len(raw) * 10 // 3 > capacities[last]:
+            continue
+        count_bits = qrcode.util.mode_sizes_for_version(first)
+        segments = []
+        start = 0
+        modes = _segment_modes(raw, count_bits)
+        for i in range(1, len(raw) + 1):
+            if i == len(raw) or modes[i] != modes[start]:
+                segments.append((modes[start], raw[start:i]))
+                start = i
+        bits = sum(_segment_bits(mode, len(chunk), count_bits)
+                   for mode, chunk in segments)
+
+        version = bisect_left(capacities, bits, first, last + 1)
+        if version <= last:
+            return EncodingPlan(version, tuple(segments), bits)
+    raise qrcode.exceptions.DataOverflowError(
+        f"Payload of {len(raw)} bytes doesn't fit in a version 40 code")
+
+
+def describe_plan(plan):
+    """One-line summary such as 'Version 3 (29x29): 6 byte + 12 numeric'"""
+    size = 17 + 4 * plan.version
+    parts = " + ".join(f"{len(chunk)} {MODE_NAMES[mode]}"
+                       for mode, chunk in plan.segments)
+    return f"Version {plan.version} ({size}x{size}): {parts or 'empty'}"
+
+
+def _blank_symbol(version):
+    """A qrcode.QRCode with an empty module grid of the version's size"""
+    qr = qrcode.QRCode(version=version)
+    qr.modules_count = 17 + 4 * version
+    qr.modules = [[None] * qr.modules_count for _ in range(qr.modules_count)]
+    return qr
+
+
+@functools.lru_cache(maxsize=None)
+def symbol_layout(version):
+    """Parts of a symbol that are the same for every payload of a version.
+
+    Returns (template, rows, cols, masks): the function patterns with the
+    format and version areas light, the data module coordinates in
+    placement order, and the eight masks as an (8, n, n) array that is
+    only set on data modules. All come from qrcode's own setup code.
+    """
+    qr = _blank_symbol(version)
+    n = qr.modules_count
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+
+    function = np.array([[cell is not None for cell in row] for row in qr.modules])
+    template = np.array([[cell is True for cell in row] for row in qr.modules])
+
+    # Same zigzag as QRCode.map_data: column pairs from the right,
+    # alternately upwards and downwards, skipping the timing column
+    rows, cols = [], []
+    upwards = True
+    for right in range(n - 1, 0, -2):
+        if right <= 6:
+            right -= 1
+        for row in (range(n - 1, -1, -1) if upwards else range(n)):
+            for col in (right, right - 1):
+                if not function[row, col]:
+                    rows.append(row)
+                    cols.append(col)
+        upwards = not upwards
+
+    i, j = np.indices((n, n))
+    masks = np.stack([mask(i, j) & ~function for mask in MASK_FUNCTIONS])
+    for array in (template, masks):
+        array.setflags(write=False)
+    return template, np.array(rows), np.array(cols), masks
+
+
+@functools.lru_cache(maxsize=None)
+def _format_cells(version, error_correction, mask_pattern):
+    """(rows, cols, values) of the format and version information"""
+    qr = _blank_symbol(version)
+    qr.error_correction = error_correction
+    qr.setup_type_info(False, mask_pattern)
+    if version >= 7:
+        qr.setup_type_number(False)
+    cells = [(row, col, value) for row, line in enumerate(qr.modules)
+             for col, value in enumerate(line) if value is not None]
+    rows, cols, values = zip(*cells)
+    return np.array(rows), np.array(cols), np.array(values)
+
+
+def _run_penalty(candidates):
+    """Penalty for runs of five or more same-colored modules along rows"""
+    count, n, _ = candidates.shape
+    # A sentinel column of 2 ends every row's last run
+    cells = np.full((count, n, n + 1), 2, dtype=np.int8)
+    cells[:, :, :n] = candidates
+    cells = cells.ravel()
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(cells)) + 1))
+    lengths = np.diff(np.append(starts, cells.size))
+    long = lengths >= 5
+    return np.bincount(starts[long] // (n * (n + 1)),
+                       weights=lengths[long] - 2, minlength=count)
+
+
+def _finder_penalty(candidates):
+    """Penalty for finder-like patterns along rows"""
+    n = candidates.shape[-1]
+    windows = np.zeros(candidates.shape[:-1] + (n - 10,), dtype=np.int16)
+    for k in range(11):
+        windows = (windows << 1) | candidates[:, :, k:n - 10 + k]
+    found = np.zeros(windows.shape, dtype=bool)
+    for pattern in FINDER_LIKE_PATTERNS:
+        found |= windows == pattern
+    return found.sum(axis=(1, 2)) * 40
+
+
+def mask_penalties(candidates):
+    """Score masked symbols with the four standard penalty rules.
+
+    candidates is a (k, n, n) boolean array, one masked symbol per mask.
+    Every rule is a whole-array operation, so all eight masks cost
+    about as much as a single pass in Python. Scores equal qrcode's
+    util.lost_point for the same symbols.
+    """
+    n = candidates.shape[-1]
+    columns = candidates.transpose(0, 2, 1)
+    runs = _run_penalty(candidates) + _run_penalty(np.ascontiguousarray(columns))
+
+    corner = candidates[:, :-1, :-1]
+    blocks = ((corner == candidates[:, :-1, 1:]) &
+              (corner == candidates[:, 1:, :-1]) &
+              (corner == candidates[:, 1:, 1:])).sum(axis=(1, 2)) * 3
+
+    finders = _finder_penalty(candidates) + _finder_penalty(columns)
+
+    dark = candidates.sum(axis=(1, 2))
+    balance = np.array([int(abs(float(count) / (n * n) * 100 - 50) / 5) * 10
+                        for count in dark])
+    return runs.astype(int) + blocks + finders + balance
+
+
+def encode(data, error_correction=qrcode.constants.ERROR_CORRECT_H,
+           mask_pattern=None):
+    """Encode data: planned segments, Reed-Solomon, then the mask.
+
+    The data bits are placed once and all eight masks are applied and
+    scored as arrays. mask_pattern (0-7) skips scoring and uses that
+    mask, for payloads whose codes are already known to scan well.
+    """
+    if mask_pattern is not None and mask_pattern not in range(8):
+        raise ValueError(f"Mask pattern must be 0-7, got {mask_pattern}")
+    plan = plan_encoding(data, error_correction)
+    data_list = [qrcode.util.QRData(chunk, mode=mode, check_data=False)
+                 for mode, chunk in plan.segments]
+    data_cache = qrcode.util.create_data(plan.version, error_correction,
+                                         data_list)
+
+    template, rows, cols, masks = symbol_layout(plan.version)
+    bits = np.unpackbits(np.array(data_cache, dtype=np.uint8))
+    placed = np.zeros(len(rows), dtype=bool)
+    placed[:min(len(bits), len(rows))] = bits[:len(rows)]
+    unmasked = template.copy()
+    unmasked[rows, cols] = placed
+
+    if mask_pattern is None:
+        candidates = unmasked ^ masks
+        mask_pattern = int(np.argmin(mask_penalties(candidates)))
+        matrix = candidates[mask_pattern].copy()
+    else:
+        matrix = unmasked ^ masks[mask_pattern]
+
+    format_rows, format_cols, format_values = _format_cells(
+        plan.version, error_correction, mask_pattern)
+    matrix[format_rows, format_cols] = format_values
+    matrix.setflags(write=False)
+    return EncodedQR(plan.version, matrix, plan, mask_pattern)
+
+
+# Shared by every render path in the process
+MATRIX_CACHE = MatrixCache()
+
+
+def render_base_image(data, style=DEFAULT_STYLE):
+    """Render the QR code with colors and gradient but without a logo"""
+    if style.shaped:
+        encoded = MATRIX_CACHE.get(data, style.error_correction,
+                                   style.mask_pattern)
+        return colorize(shape_mask(encoded, style), style)
+
+    # Gradients are painted through the module mask instead of a drawn image
+    if style.use_gradient:
+        encoded = MATRIX_CACHE.get(data, style.error_correction,
+                                   style.mask_pattern)
+        dark = padded_matrix(encoded, style.border)
+        dark = dark.repeat(style.box_size, axis=0).repeat(style.box_size, axis=1)
+        return colorize(dark, style)
+
+    encoded = MATRIX_CACHE.get(data, style.error_correction, style.mask_pattern)
+    return rasterize(padded_matrix(encoded, style.border), style, style.box_size)
+
+
+def render_image(data, style=DEFAULT_STYLE):
+    """Render the QR code as a PIL image, including the logo if one is set"""
+    img = render_base_image(data, style)
+    if style.logo_path:
+        img = add_logo(img, style.logo_path, style.logo_shape)
+    return img
+
+
+def padded_matrix(encoded, border):
+    """Module matrix with the quiet zone added, True for dark modules"""
+    return np.pad(encoded.matrix, border, constant_values=False)
+
+
+def rasterize(matrix, style=DEFAULT_STYLE, box_size=1):
+    """Expand a boolean module matrix into an image with box_size pixels per module.
+
+    The image is built in the smallest buffer that holds the style:
+    packed bits for black on white (mode '1'), palette indices for two
+    other opaque colors ('P') and RGBA pixels over a transparent
+    background. Each is repeated out to full size with np.repeat, rows
+    last so whole rows are copied. PIL wraps 'P' and 'RGBA' buffers
+    without a copy; it can't map packed bits, so mode '1' is copied once
+    by frombytes.
+    """
+    fill = parse_color(style.fill_color)
+    back = parse_color(style.bg_color)
+
+    if style.transparent_bg:
+        palette = np.array([(0, 0, 0, 0), fill + (255,)], dtype=np.uint8)
+        mode, pixels = 'RGBA', palette[matrix.view(np.uint8)]
+    elif fill == (0, 0, 0) and back == (255, 255, 255):
+        # Mode '1' stores white as 1, eight pixels per byte
+        mode = '1'
+        pixels = np.packbits(np.repeat(~matrix, box_size, axis=1), axis=1)
+    else:
+        mode, pixels = 'P', matrix.view(np.uint8)
+
+    if mode != '1':
+        pixels = np.repeat(pixels, box_size, axis=1)
+    pixels = np.ascontiguousarray(np.repeat(pixels, box_size, axis=0))
+
+    height, width = matrix.shape[0] * box_size, matrix.shape[1] * box_size
+    if mode == '1':
+        return Image.frombytes(mode, (width, height), pixels)
+    img = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+    if mode == 'P':
+        img.putpalette(back + fill)
+    return img
+
+
+def module_runs(matrix):
+    """Find horizontal runs of dark modules.
+
+    Returns (rows, starts, lengths) arrays, one entry per run, so vector
+    writers can emit one rectangle per run instead of one per module.
+    """
+    height, width = matrix.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = matrix
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - starts
+
+
+def _draw_stamp(size, draw):
+    """Rasterize draw(ImageDraw, big_size) at STAMP_SUPERSAMPLE and shrink it"""
+    big = size * STAMP_SUPERSAMPLE
+    img = Image.new('L', (big, big), 0)
+    draw(ImageDraw.Draw(img), big)
+    stamp = np.asarray(img.resize((size, size), Image.Resampling.BOX))
+    stamp.setflags(write=False)
+    return stamp
+
+
+@functools.lru_cache(maxsize=32)
+def module_stamp(shape, box_size):
+    """Anti-aliased coverage (0-255) of one dark module in the given shape"""
+    if shape not in MODULE_SHAPES:
+        raise ValueError(f"Unknown module shape: {shape}")
+
+    def draw(d, size):
+        if shape == "dots":
+            # Smaller than the module so neighbouring dots stay separate
+            inset = size * 0.15
+            d.ellipse((inset, inset, size - inset, size - inset), fill=255)
+        elif shape == "circles":
+            d.ellipse((0, 0, size, size), fill=255)
+        elif shape == "rounded":
+            d.rounded_rectangle((0, 0, size - 1, size - 1),
+                                radius=size * 0.35, fill=255)
+        else:
+            d.rectangle((0, 0, size, size), fill=255)
+
+    return _draw_stamp(box_size, draw)
+
+
+@functools.lru_cache(maxsize=32)
+def eye_stamp(pattern, box_size):
+    """Anti-aliased coverage of a whole 7x7-module finder pattern"""
+    if pattern not in EYE_PATTERNS:
+        raise ValueError(f"Unknown eye pattern: {pattern}")
+
+    def draw(d, size):
+        m = size / 7
+        outer = (0, 0, size - 1, size - 1)
+        hole = (m, m, size - 1 - m, size - 1 - m)
+        ball = (2 * m, 2 * m, size - 1 - 2 * m, size - 1 - 2 * m)
+        if pattern == "circle":
+            d.ellipse(outer, fill=255)
+            d.ellipse(hole, fill=0)
+            d.ellipse(ball, fill=255)
+        elif pattern == "rounded":
+            d.rounded_rectangle(outer, radius=2 * m, fill=255)
+            d.rounded_rectangle(hole, radius=m, fill=0)
+            d.rounded_rectangle(ball, radius=m, fill=255)
+        else:
+            d.rectangle(outer, fill=255)
+            d.rectangle(hole, fill=0)
+            if pattern == "diamond":
+                # Slightly wider than the 3-module ball so scan lines near
+                # the centre still see the 1:1:3:1:1 finder ratio
+                c = size / 2
+                d.polygon([(c, c - 1.75 * m), (c + 1.75 * m, c),
+                           (c, c + 1.75 * m), (c - 1.75 * m, c)], fill=255)
+            else:
+                d.rectangle(ball, fill=255)
+
+    return _draw_stamp(7 * box_size, draw)
+
+
+def shape_mask(encoded, style=DEFAULT_STYLE):
+    """Render the code as an anti-aliased uint8 coverage mask.
+
+    Every dark module gets the same precomputed stamp, tiled in one
+    broadcast multiply over the module matrix, and the three finder
+    patterns are then overwritten with the eye stamp.
+    """
+    matrix = padded_matrix(encoded, style.border)
+    box = style.box_size
+    count = matrix.shape[0]
+
+    stamp = module_stamp(style.module_shape, box)
+    mask = (matrix.view(np.uint8)[:, None, :, None] *
+            stamp[None, :, None, :]).reshape(count * box, count * box)
+
+    eye = eye_stamp(style.eye_pattern, box)
+    modules = len(encoded.matrix)
+    for row, col in ((0, 0), (0, modules - 7), (modules - 7, 0)):
+        y = (row + style.border) * box
+        x = (col + style.border) * box
+        mask[y:y + 7 * box, x:x + 7 * box] = eye
+    return mask
+
+
+def colorize(dark, style=DEFAULT_STYLE):
+    """Turn a pixel mask into an image with the style's colors.
+
+    dark is either boolean or a uint8 coverage mask from shape_mask, whose
+    edge pixels are blended between the fill and the background.
+    """
+    if style.use_gradient:
+        return apply_gradient(dark, style)
+
+    if dark.dtype != bool:
+        # The coverage mask is already a palette index: entry i is the
+        # fill blended over the background at coverage i
+        dark = np.ascontiguousarray(dark)
+        height, width = dark.shape
+        img = Image.frombuffer('P', (width, height), dark, 'raw', 'P', 0, 1)
+        img.putpalette(*coverage_palette(style))
+        return img
+
+    return rasterize(dark, style)
+
+
+@functools.lru_cache(maxsize=32)
+def _coverage_palette(fill_color, bg_color, transparent_bg):
+    fill = parse_color(fill_color)
+    if transparent_bg:
+        return bytes(channel for alpha in range(256)
+                     for channel in fill + (alpha,)), 'RGBA'
+
+    # Blend with PIL's own masked paste so entries match what pasting the
+    # fill through the mask would give, pixel for pixel
+    ramp = Image.new('L', (256, 1))
+    ramp.putdata(range(256))
+    blend = Image.new('RGB', ramp.size, parse_color(bg_color))
+    blend.paste(fill, None, ramp)
+    return blend.tobytes(), 'RGB'
+
+
+def coverage_palette(style=DEFAULT_STYLE):
+    """Return (palette bytes, palette mode) for indexing a coverage mask"""
+    return _coverage_palette(style.fill_color, style.bg_color,
+                             style.transparent_bg)
+
+
+def render_preview(data, style=DEFAULT_STYLE, size=150, cache=MATRIX_CACHE):
+    """Render a preview straight at size x size pixels.
+
+    Each output pixel picks its module by nearest-neighbour index, so there
+    is no full-size render and no resampling filter, and module edges stay
+    sharp.
+    """
+    encoded = cache.get(data, style.error_correction, style.mask_pattern)
+    matrix = padded_matrix(encoded, style.border)
+    if style.shaped:
+        # Shapes need a few pixels per module; stamp small, then shrink the
+        # coverage mask before coloring it
+        box = -(-size // matrix.shape[0])
+        mask = Image.fromarray(shape_mask(encoded, style.with_options(box_size=box)))
+        return colorize(np.asarray(mask.resize((size, size), Image.Resampling.BOX)),
+                        style)
+
+    index = np.arange(size) * matrix.shape[0] // size
+    return colorize(matrix[np.ix_(index, index)], style)
+
+
+class PreviewScheduler:
+    """Single background worker that only renders the newest preview request.
+
+    submit() never blocks: it replaces whatever request is still waiting.
+    The worker waits until submissions have been quiet for `debounce`
+    seconds, renders once, and only hands the result to `deliver` if no
+    newer request arrived meanwhile.
+    """
+
+    def __init__(self, render, deliver, debounce=0.08):
+        self.debounce = debounce
+        self._render = render
+        self._deliver = deliver
+        self._cond = threading.Condition()
+        self._pending = None
+        self._generation = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, *args):
+        """Queue a render, superseding any request not yet started"""
+        with self._cond:
+            self._generation += 1
+            self._pending = (self._generation, args)
+            self._cond.notify()
+            return self._generation
+
+    def is_current(self, generation):
+        """True if no request newer than generation has been submitted"""
+        with self._cond:
+            return generation == self._generation
+
+    def stop(self):
+        """Stop the worker thread, dropping any pending request"""
+        with self._cond:
+            self._stopped = True
+            self._pending = None
+            self._cond.notify()
+
+    def _next_request(self):
+        """Block until a request has been quiet for the debounce interval"""
+        with self._cond:
+            while True:
+                while self._pending is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return None
+
+                generation = self._pending[0]
+                self._cond.wait(self.debounce)
+                if self._stopped:
+                    return None
+                if self._pending is not None and self._pending[0] == generation:
+                    request = self._pending
+                    self._pending = None
+                    return request
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            generation, args = request
+
+            start = time.perf_counter()
+            try:
+                result = self._render(*args)
+            except Exception as e:
+                print(f"Preview generation error: {e}")
+                continue
+            latency = time.perf_counter() - start
+
+            # Drop results that were superseded while rendering
+            if self.is_current(generation):
+                self._deliver(generation, result, latency)
+
+
+def gradient_field(width, height, start_color, end_color, mode="horizontal"):
+    """Return the RGB gradient image for the given size.
+
+    The colour ramp is computed once per axis and broadcast to the full
+    frame. Renderers go through GRADIENT_CACHE instead of calling this.
+    """
+    if mode not in GRADIENT_MODES:
+        raise ValueError(f"Unknown gradient mode: {mode}")
+
+    x = np.arange(width, dtype=np.float32)[None, :] / width
+    y = np.arange(height, dtype=np.float32)[:, None] / height
+    if mode == "horizontal":
+        ratio = x
+    elif mode == "vertical":
+        ratio = y
+    elif mode == "diagonal":
+        ratio = (x + y) / 2
+    else:
+        # Distance from the centre, 1.0 at the corners
+        ratio = np.hypot(x - 0.5, y - 0.5) / np.hypot(0.5, 0.5)
+
+    start = np.array(parse_color(start_color), dtype=np.float32)
+    end = np.array(parse_color(end_color), dtype=np.float32)
+    field = (start + ratio[..., None] * (end - start)).astype(np.uint8)
+    return Image.fromarray(np.ascontiguousarray(
+        np.broadcast_to(field, (height, width, 3))), 'RGB')
+
+
+class BudgetedLRU:
+    """Thread-safe LRU map that evicts by a memory budget, not a count.
+
+    cost(value) estimates the bytes a value holds. Least recently used
+    entries are evicted once the total exceeds max_bytes, but the newest
+    entry is always kept, even if it alone is over budget. A key can be
+    reserved before its value exists; the None placeholder costs nothing
+    and reads as a miss. GradientCache, LogoCache and the bulk engine's
+    RenderCache all store their entries in one of these.
+    """
+
+    def __init__(self, max_bytes, cost):
+        self.max_bytes = max_bytes
+        self.cost = cost
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None on a miss"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def reserve(self, key):
+        """True if key is already present; otherwise add a placeholder and return False"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            self._entries[key] = None
+            return False
+
+    def put(self, key, value):
+        """Store value under key, then evict down to the budget"""
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._bytes -= self.cost(previous)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._bytes += self.cost(value)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                if evicted is not None:
+                    self._bytes -= self.cost(evicted)
+
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and memory use"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
+
+
+class GradientCache:
+    """Thread-safe cache of gradient fields with a memory budget.
+
+    The same field is reused for every code of a bulk run that has the
+    same size. Codes of different versions need different sizes, so
+    least recently used fields are evicted once their pixels exceed
+    max_bytes instead of keeping a fixed number of full-frame images.
+    Fields are shared: paste from them, never draw on them.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self._entries = BudgetedLRU(
+            max_bytes, lambda field: field.width * field.height * 3)
+
+    def get(self, width, height, start_color, end_color, mode="horizontal"):
+        """Return the field, computing it on a miss"""
+        key = (width, height, start_color, end_color, mode)
+        field = self._entries.get(key)
+        if field is None:
+            field = gradient_field(width, height, start_color, end_color, mode)
+            self._entries.put(key, field)
+        return field
+
+    def clear(self):
+        """Drop all fields"""
+        self._entries.clear()
+
+
+# Shared by every render path in the process
+GRADIENT_CACHE = GradientCache()
+
+
+def apply_gradient(dark, style=DEFAULT_STYLE, cache=GRADIENT_CACHE):
+    """Paint the gradient onto the dark pixels of a boolean or coverage mask"""
+    height, width = dark.shape
+    field = cache.get(width, height, style.gradient_start,
+                      style.gradient_end, style.gradient_mode)
+
+    if style.transparent_bg and dark.dtype != bool:
+        # Coverage becomes alpha, so soft edges don't fade towards black
+        img = field.convert('RGBA')
+        img.putalpha(Image.fromarray(dark, 'L'))
+        return img
+
+    if style.transparent_bg:
+        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    else:
+        img = Image.new('RGB', (width, height), parse_color(style.bg_color))
+
+    # PIL's masked paste is a single C pass, much cheaper than np.where
+    img.paste(field, (0, 0), Image.fromarray(dark))
+    return img
+
+
+def prepare_logo(logo_path, size, shape="circle"):
+    """Load a logo as a size x size RGBA sprite whose alpha is the mask"""
+    if shape not in LOGO_SHAPES:
+        raise ValueError(f"Unknown logo shape: {shape}")
+
+    with Image.open(logo_path) as logo:
+        sprite = logo.convert('RGB').resize((size, size),
+                                            Image.Resampling.LANCZOS)
+
+    # Create the mask for the logo
+    mask = Image.new('L', (size, size), 0)
+    draw = ImageDraw.Draw(mask)
+    if shape == "circle":
+        draw.ellipse((0, 0, size, size), fill=255)
+    elif shape == "rounded":
+        draw.rounded_rectangle((0, 0, size - 1, size - 1),
+                               radius=size // 5, fill=255)
+    else:
+        draw.rectangle((0, 0, size, size), fill=255)
+
+    sprite.putalpha(mask)
+    return sprite
+
+
+class LogoCache:
+    """Thread-safe cache of prepared logo sprites with a memory budget.
+
+    Keyed by (path, mtime, size, shape), so editing the file on disk
+    invalidates it. Least recently used sprites are evicted once their
+    pixel data exceeds max_bytes. Sprites are shared: paste from them,
+    never draw on them.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self._entries = BudgetedLRU(
+            max_bytes, lambda sprite: sprite.width * sprite.height * 4)
+
+    def get(self, logo_path, size, shape="circle"):
+        """Return the prepared sprite, decoding the file on a miss"""
+        key = (os.path.abspath(logo_path), os.stat(logo_path).st_mtime_ns,
+               size, shape)
+        sprite = self._entries.get(key)
+        if sprite is None:
+            sprite = prepare_logo(logo_path, size, shape)
+            self._entries.put(key, sprite)
+        return sprite
+
+    def clear(self):
+        """Drop all sprites and reset the counters"""
+        self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and memory use"""
+        return self._entries.stats()
+
+
+# Shared by every render path in the process
+LOGO_CACHE = LogoCache()
+
+
+def add_logo(img, logo_path, shape="circle", cache=LOGO_CACHE):
+    """Paste a masked logo in the centre of the image"""
+    # Resize logo to 20% of QR code size
+    qr_size = min(img.size) // 5
+    sprite = cache.get(logo_path, qr_size, shape)
+
+    # Paste logo with mask
+    if img.mode == 'P' and img.palette.mode == 'RGBA':
+        img = img.convert('RGBA')
+    elif img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    pos = ((img.size[0] - qr_size) // 2,
+           (img.size[1] - qr_size) // 2)
+    img.paste(sprite, pos, sprite)
+    return img
+
+
+# zlib settings for PNG output, from quickest to smallest files
+PNG_PRESETS = {
+    "fast": {"compress_level": 1},
+    "balanced": {"compress_level": 6},
+    "smallest": {"compress_level": 9, "optimize": True},
+}
+DEFAULT_PNG_PRESET = "balanced"
+
+
+def png_save_options(preset=DEFAULT_PNG_PRESET):
+    """Return the PIL save options of a PNG_PRESETS entry"""
+    if preset not in PNG_PRESETS:
+        raise ValueError(f"Unknown PNG preset: {preset}")
+    return dict(PNG_PRESETS[preset])
+
+
+def reduce_png_mode(img):
+    """Return img in the smallest PNG mode that holds its pixels exactly.
+
+    Pure black and white becomes 1-bit, anything with at most 256 colors
+    (solid fills, anti-aliased shapes, transparent backgrounds) becomes a
+    palette, which PIL writes with 1, 2, 4 or 8 bits per pixel depending on
+    its length. Only images with more colors, i.e. gradients and photo
+    logos, stay RGB(A). Palette images drop the entries no pixel uses, so
+    a coverage mask with few distinct levels still gets a short palette.
+    """
+    if img.mode == 'P':
+        return _compact_palette(img)
+    if img.mode not in ('RGB', 'RGBA'):
+        return img
+
+    # getcolors gives up (returns None) past 256 colors
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+    colors = [color for _, color in colors]
+
+    if img.mode == 'RGBA' and all(color[3] == 255 for color in colors):
+        img = img.convert('RGB')
+        colors = [color[:3] for color in colors]
+    if img.mode == 'RGB' and set(colors) <= {(0, 0, 0), (255, 255, 255)}:
+        return img.convert('1', dither=Image.Dither.NONE)
+
+    # Look each pixel up exactly, as one uint32 per RGBA pixel. PIL's own
+    # quantize(palette=...) snaps neighbouring gradient shades together.
+    table = np.array([color + (255,) * (4 - len(color)) for color in colors],
+                     dtype=np.uint8).view(np.uint32).ravel()
+    order = np.argsort(table)
+    table, order = table[order], order.astype(np.uint8)
+
+    # In bands of rows, so the RGBA copy and int64 lookups stay small
+    width, height = img.size
+    indices = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, 256):
+        bottom = min(top + 256, height)
+        band = img.crop((0, top, width, bottom)).convert('RGBA')
+        keys = np.asarray(band).view(np.uint32)[..., 0]
+        indices[top:bottom] = order[np.searchsorted(table, keys)]
+
+    reduced = Image.fromarray(indices, 'P')
+    reduced.putpalette(bytes(np.array(colors, dtype=np.uint8).ravel()),
+                       img.mode)
+    return reduced
+
+
+def _compact_palette(img):
+    """Return a palette image without the entries its pixels don't use"""
+    mode = img.palette.mode
+    palette = np.frombuffer(bytes(img.getpalette(mode)), dtype=np.uint8)
+    palette = palette.reshape(-1, len(mode))
+    if len(palette) <= 2:
+        return img
+
+    indices = np.asarray(img)
+    used = np.flatnonzero(np.bincount(indices.ravel(), minlength=256))
+    if len(used) == len(palette):
+        return img
+
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[used] = np.arange(len(used))
+    compact = Image.fromarray(lookup[indices], 'P')
+    compact.putpalette(palette[used].tobytes(), mode)
+    return compact
+
+
+def save_png(img, fp, preset=DEFAULT_PNG_PRESET, **save_kwargs):
+    """Save img as a PNG in its smallest lossless mode with a compression preset.
+
+    fp is a path or binary file object; save_kwargs (e.g. dpi) go to PIL
+    and override the preset.
+    """
+    options = png_save_options(preset)
+    options.update(save_kwargs)
+    reduce_png_mode(img).save(fp, format="PNG", **options)
+
+
+def flatten(img, background="white"):
+    """Return img as RGB, with any transparency composited onto background"""
+    if img.mode == 'RGB':
+        return img
+    img = img.convert('RGBA')
+    flat = Image.new('RGB', img.size, parse_color(background))
+    flat.paste(img, None, img)
+    return flat
+
+
+def save_image(img, path, preset=DEFAULT_PNG_PRESET, background="white",
+               **save_kwargs):
+    """Save img to path, through save_png unless the extension asks for another format.
+
+    Other formats (JPEG, BMP, ...) get an RGB image, with transparency
+    flattened onto background, since most can't store palettes or alpha.
+    """
+    if os.path.splitext(path)[1].lower() in ('.png', ''):
+        save_png(img, path, preset, **save_kwargs)
+    else:
+        flatten(img, background).save(path, **save_kwargs)
+
+
+def image_to_png_bytes(img, preset=DEFAULT_PNG_PRESET, **save_kwargs):
+    """Encode a PIL image as PNG bytes, see save_png"""
+    buffer = BytesIO()
+    save_png(img, buffer, preset, **save_kwargs)
+    return buffer.getvalue()
+
+
+def render_png(data, style=DEFAULT_STYLE, preset=DEFAULT_PNG_PRESET,
+               **save_kwargs):
+    """Render the QR code and return PNG bytes"""
+    return image_to_png_bytes(render_image(data, style), preset, **save_kwargs)
+
@@ -0,0 +1,598 @@
+"""Headless QR scanning.
+
+Decoding helpers shared by the image scanner and the camera pipeline.
+CameraScanner keeps capture and decode off the Tk thread: one thread
+reads the camera as fast as it delivers frames, a second one decodes
+only the newest frame at a fixed rate, and the UI is handed nothing but
+the latest annotated result.
+
+verify_bulk decodes a whole bulk output folder or ZIP in worker
+processes and checks every code against the CSV row it was made from.
+"""
+import argparse
+import csv
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import qr_bulk
+
+try:
+    import zxingcpp
+except ImportError:  # optional; lets verify read styles OpenCV can't
+    zxingcpp = None
+
+
+# Frames are shrunk so their longest side is at most this before detection
+DETECT_MAX_SIDE = 640
+
+# Size of the annotated frame handed to the UI
+DISPLAY_SIZE = (400, 300)
+
+# Raster formats the batch scanner can decode
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+# Mean absolute difference (0-255) between thumbnails of a tracked
+# region above which the code in it is decoded again
+REGION_CHANGE_THRESHOLD = 10
+
+# A code found in a frame: payload and corner points in frame coordinates
+TrackedCode = namedtuple("TrackedCode", ["data", "points"])
+
+# What the camera pipeline hands to the UI. image is an RGB PIL image at
+# display size, codes the TrackedCodes from the last decode.
+ScanFrame = namedtuple("ScanFrame", ["image", "codes", "fps", "latency"])
+
+_local = threading.local()
+
+
+def detector():
+    """Return this thread's QRCodeDetector, created once and reused"""
+    if not hasattr(_local, "detector"):
+        _local.detector = cv2.QRCodeDetector()
+    return _local.detector
+
+
+def fallback_detector():
+    """Return this thread's second-opinion detector, or None if unavailable.
+
+    The ArUco-based detector (OpenCV 4.8+) finds finder patterns
+    differently and reads some codes the classic detector misses.
+    """
+    if not hasattr(_local, "fallback"):
+        factory = getattr(cv2, "QRCodeDetectorAruco", None)
+        _local.fallback = factory() if factory else None
+    return _local.fallback
+
+
+def detection_frame(frame, max_side=DETECT_MAX_SIDE):
+    """Return (grayscale frame no larger than max_side, scale factor used).
+
+    max_side=None keeps the full resolution.
+    """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height, width = frame.shape
+    scale = min(1.0, (max_side or max(height, width)) / max(height, width))
+    if scale < 1.0:
+        frame = cv2.resize(frame, (round(width * scale), round(height * scale)),
+                           interpolation=cv2.INTER_AREA)
+    return frame, scale
+
+
+def decode_frame(frame, max_side=DETECT_MAX_SIDE):
+    """Decode one BGR or grayscale frame.
+
+    Returns (data, points) where points are the code's corners in the
+    coordinates of the original frame, or None if nothing was found.
+    """
+    gray, scale = detection_frame(frame, max_side)
+    data, points, _ = detector().detectAndDecode(gray)
+    if points is None:
+        return data, None
+    return data, points.reshape(-1, 2) / scale
+
+
+def decode_image(path, max_side=None):
+    """Decode every QR code in an image file, full resolution by default.
+
+    Returns the payloads in the order they were found.
+    """
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError(f"Could not read image: {path}")
+    codes = CodeTracker(max_side).update(img)
+    if not codes:
+        # detectMulti can miss a lone code that the single detector finds
+        data, _ = decode_frame(img, max_side)
+        return [data] if data else []
+    return [code.data for code in codes]
+
+
+def _region_thumbnail(gray, points, size=16):
+    """Small grayscale thumbnail of the bounding box of points, or None"""
+    x, y, w, h = cv2.boundingRect(points.astype(np.float32))
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, gray.shape[1]), min(y + h, gray.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return cv2.resize(gray[y0:y1, x0:x1], (size, size),
+                      interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class CodeTracker:
+    """Multi-code detection that only re-decodes regions that changed.
+
+    Each update() locates every code in the frame and matches it by
+    position to a code found in the previous update. If a thumbnail of
+    the region still looks the same, the earlier payload is reused, and
+    only new or changed regions go through the much slower decoder.
+    """
+
+    def __init__(self, max_side=DETECT_MAX_SIDE,
+                 threshold=REGION_CHANGE_THRESHOLD):
+        self.max_side = max_side
+        self.threshold = threshold
+        self.decoded = 0
+        self.reused = 0
+        self._tracked = []  # (data, points, thumbnail) in detection coordinates
+
+    def update(self, frame):
+        """Return a TrackedCode for every readable code in a BGR or gray frame"""
+        gray, scale = detection_frame(frame, self.max_side)
+        found, points = detector().detectMulti(gray)
+        if not found:
+            self._tracked = []
+            return []
+
+        points = points.reshape(-1, 4, 2).astype(np.float32)
+        thumbnails = [_region_thumbnail(gray, quad) for quad in points]
+        payloads = [""] * len(points)
+        changed = []
+        for i, (quad, thumbnail) in enumerate(zip(points, thumbnails)):
+            previous = self._match(quad)
+            if (previous is not None and thumbnail is not None and
+                    np.abs(thumbnail - previous[2]).mean() < self.threshold):
+                payloads[i] = previous[0]
+                self.reused += 1
+            else:
+                changed.append(i)
+
+        if changed:
+            ok, decoded, _ = detector().decodeMulti(gray, points[changed])
+            if ok:
+                for i, data in zip(changed, decoded):
+                    payloads[i] = data
+            self.decoded += len(changed)
+
+        # Codes that failed to decode aren't tracked, so they retry next time
+        self._tracked = [(data, quad, thumbnail) for data, quad, thumbnail
+                         in zip(payloads, points, thumbnails)
+                         if data and thumbnail is not None]
+        return [TrackedCode(data, quad / scale) for data, quad, _ in self._tracked]
+
+    def _match(self, quad):
+        """Return the tracked entry nearest quad's centre, if it overlaps"""
+        center = quad.mean(axis=0)
+        best, best_distance = None, None
+        for entry in self._tracked:
+            tracked = entry[1]
+            distance = np.linalg.norm(center - tracked.mean(axis=0))
+            radius = np.linalg.norm(tracked[0] - tracked[2]) / 2
+            if distance < radius and (best is None or distance < best_distance):
+                best, best_distance = entry, distance
+        return best
+
+
+class ScanResults:
+    """Deduplicated payloads seen by a scanner, in first-seen order"""
+
+    def __init__(self):
+        self._counts = OrderedDict()
+
+    def add(self, codes):
+        """Record TrackedCodes (or payloads) and return the new payloads"""
+        new = []
+        for code in codes:
+            data = getattr(code, "data", code)
+            if not data:
+                continue
+            if data not in self._counts:
+                new.append(data)
+            self._counts[data] = self._counts.get(data, 0) + 1
+        return new
+
+    def counts(self):
+        """Return [(payload, times seen)] in first-seen order"""
+        return list(self._counts.items())
+
+    def clear(self):
+        self._counts.clear()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+
+class CameraScanner:
+    """Background capture and decode pipeline for a cv2.VideoCapture.
+
+    deliver() is called from the worker whenever a new frame is ready and
+    the previous one has been collected; the UI then calls latest() from
+    its own thread. Frames arriving faster than the UI collects them
+    replace each other instead of queueing.
+    """
+
+    def __init__(self, capture, deliver, decode_rate=10.0,
+                 display_size=DISPLAY_SIZE, max_side=DETECT_MAX_SIDE):
+        self.capture = capture
+        self.decode_rate = decode_rate
+        self.display_size = display_size
+        self.tracker = CodeTracker(max_side)
+        self._deliver = deliver
+        self._cond = threading.Condition()
+        self._frame = None
+        self._frame_id = 0
+        self._latest = None
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._capture_loop, daemon=True),
+                         threading.Thread(target=self._process_loop, daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop both threads and release the capture"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            if thread.is_alive() and thread is not threading.current_thread():
+                thread.join(timeout=1.0)
+        self.capture.release()
+
+    def latest(self):
+        """Take the newest ScanFrame (or None) and allow the next delivery"""
+        with self._cond:
+            frame, self._latest = self._latest, None
+            return frame
+
+    def _capture_loop(self):
+        # Read continuously so the driver's buffer never holds stale frames
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+            ok, frame = self.capture.read()
+            if not ok:
+                time.sleep(0.01)
+                continue
+            with self._cond:
+                self._frame = frame
+                self._frame_id += 1
+                self._cond.notify_all()
+
+    def _process_loop(self):
+        seen = 0
+        fps = 0.0
+        latency = 0.0
+        last_shown = None
+        next_decode = 0.0
+        codes = []
+
+        while True:
+            with self._cond:
+                while self._frame_id == seen and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                frame, seen = self._frame, self._frame_id
+
+            now = time.perf_counter()
+            if now >= next_decode:
+                next_decode = now + 1.0 / self.decode_rate
+                codes = self.tracker.update(frame)
+                latency = time.perf_counter() - now
+
+            image = self._annotate(frame, codes)
+
+            if last_shown is not None:
+                # Smoothed so the readout doesn't flicker
+                fps = 0.9 * fps + 0.1 / max(now - last_shown, 1e-6)
+            last_shown = now
+
+            with self._cond:
+                idle = self._latest is None
+                self._latest = ScanFrame(image, codes, fps, latency)
+            if idle:
+                self._deliver()
+
+    def _annotate(self, frame, codes):
+        """Scale the frame to display size and outline the codes found"""
+        height, width = frame.shape[:2]
+        display_width, display_height = self.display_size
+        small = cv2.resize(frame, self.display_size, interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        if codes:
+            scale = (display_width / width, display_height / height)
+            cv2.polylines(rgb, [(code.points * scale).astype(np.int32)
+                                for code in codes], True,
+                          color=(255, 0, 0), thickness=2)
+        return Image.fromarray(rgb)
+
+
+@dataclass
+class VerifyReport:
+    """Outcome of checking rendered codes against their source rows"""
+    matched: int = 0
+    mismatches: list = field(default_factory=list)  # (file, expected, decoded)
+    unreadable: list = field(default_factory=list)  # (file, expected, error)
+    missing: list = field(default_factory=list)     # expected files not found
+    unexpected: list = field(default_factory=list)  # images with no CSV row
+    elapsed: float = 0.0
+
+    @property
+    def scanned(self):
+        return self.matched + len(self.mismatches) + len(self.unreadable)
+
+    @property
+    def ok(self):
+        return not (self.mismatches or self.unreadable or self.missing)
+
+    @property
+    def images_per_second(self):
+        return self.scanned / self.elapsed if self.elapsed else 0.0
+
+
+def iter_images(source):
+    """Yield (name, file bytes) for every image in a directory or ZIP archive"""
+    if not os.path.isdir(source):
+        with zipfile.ZipFile(source) as zipf:
+            for info in zipf.infolist():
+                if (not info.is_dir() and
+                        info.filename.lower().endswith(IMAGE_EXTENSIONS)):
+                    yield info.filename, zipf.read(info)
+        return
+
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                yield name, f.read()
+
+
+def decode_bytes(content):
+    """Decode an encoded image file, returning (data, error message)"""
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8),
+                       cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None, "Could not read image"
+    if img.ndim == 3 and img.shape[2] == 4:
+        # Transparent codes are checked as if printed on white paper
+        alpha = img[:, :, 3:] / 255.0
+        img = (img[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+
+    data, _ = decode_frame(img, max_side=None)
+    if not data and fallback_detector() is not None:
+        data, _, _ = fallback_detector().detectAndDecode(img)
+    if not data and zxingcpp is not None:
+        # Also reads circle and rounded eyes, which OpenCV rejects
+        found = zxingcpp.read_barcodes(img, formats=zxingcpp.BarcodeFormat.QRCode)
+        data = found[0].text if found else ""
+    if not data:
+        return None, "No QR code found"
+    return data, None
+
+
+def _decode_chunk(contents):
+    return [decode_bytes(content) for content in contents]
+
+
+def scan_images(items, workers=None, chunksize=16, max_pending=None):
+    """Yield (name, data, error) for (name, file bytes) items, in input order.
+
+    Decoding runs in a process pool with a bounded number of chunks in
+    flight, like qr_bulk.render_rows; workers=1 decodes in this process.
+    """
+    if workers == 1:
+        for name, content in items:
+            yield (name,) + decode_bytes(content)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=qr_bulk.pool_context()) as pool:
+        for chunk in qr_bulk.iter_chunks(items, chunksize):
+            names = [name for name, _ in chunk]
+            future = pool.submit(_decode_chunk, [content for _, content in chunk])
+            pending.append((names, future))
+            if len(pending) >= max_pending:
+                names, future = pending.popleft()
+                yield from ((name,) + result
+                            for name, result in zip(names, future.result()))
+
+        while pending:
+            names, future = pending.popleft()
+            yield from ((name,) + result
+                        for name, result in zip(names, future.result()))
+
+
+def expected_files(rows, naming_template=qr_bulk.DEFAULT_NAMING_TEMPLATE,
+                   date=None, output_format="png"):
+    """Map each file a bulk run would write to the payload it should hold"""
+    date = date or datetime.now().strftime("%Y%m%d")
+    expected = {}
+    for i, row in enumerate(rows, start=1):
+        data = qr_bulk.row_payload(row)
+        if data:
+            filename = qr_bulk.row_filename(naming_template, row, i, date,
+                                            output_format)
+            expected[filename] = data
+    return expected
+
+
+def verify_bulk(source, rows, naming_template=qr_bulk.DEFAULT_NAMING_TEMPLATE,
+                date=None, workers=None, chunksize=16, progress=None,
+                output_format="png"):
+    """Decode every image in source and compare it with its CSV row.
+
+    source is a bulk output directory or ZIP archive, rows the CSV rows
+    it was generated from. naming_template and date (YYYYMMDD, default
+    today) must match the bulk run so filenames can be mapped back to
+    rows. progress, if given, is called with the number of images
+    decoded so far. Only PNG output can be decoded; output_format="svg"
+    raises ValueError rather than reporting every file missing.
+    """
+    if output_format != "png":
+        raise ValueError(f"Can't verify {output_format} output: only PNG "
+                         "images are decoded. Re-run the bulk job with "
+                         "--format png to check it.")
+
+    start = time.perf_counter()
+    report = VerifyReport()
+    expected = expected_files(rows, naming_template, date, output_format)
+
+    def known_images():
+        for name, content in iter_images(source):
+            if name in expected:
+                yield name, content
+            else:
+                report.unexpected.append(name)
+
+    seen = set()
+    results = scan_images(known_images(), workers, chunksize)
+    for i, (name, data, error) in enumerate(results, start=1):
+        seen.add(name)
+        want = expected[name]
+        if error is not None:
+            report.unreadable.append((name, want, error))
+        elif data != want:
+            report.mismatches.append((name, want, data))
+        else:
+            report.matched += 1
+
+        if progress:
+            progress(i)
+
+    report.missing = [name for name in expected if name not in seen]
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def write_verify_report(report, path):
+    """Write every problem in a VerifyReport to a CSV file"""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "status", "expected", "decoded"])
+        for name, want, data in report.mismatches:
+            writer.writerow([name, "mismatch", want, data])
+        for name, want, error in report.unreadable:
+            writer.writerow([name, "unreadable", want, error])
+        for name in report.missing:
+            writer.writerow([name, "missing", "", ""])
+        for name in report.unexpected:
+            writer.writerow([name, "unexpected", "", ""])
+
+
+def print_verify_summary(report):
+    """Print problems and the timing summary of a VerifyReport"""
+    for name, want, data in report.mismatches:
+        print(f"{name}: expected {want!r}, decoded {data!r}", file=sys.stderr)
+    for name, _, error in report.unreadable:
+        print(f"{name}: {error}", file=sys.stderr)
+
+    print(f"Scanned:    {report.scanned}")
+    print(f"Matched:    {report.matched}")
+    print(f"Mismatched: {len(report.mismatches)}")
+    print(f"Unreadable: {len(report.unreadable)}")
+    print(f"Missing:    {len(report.missing)}")
+    print(f"Unexpected: {len(report.unexpected)}")
+    print(f"Elapsed:    {report.elapsed:.2f}s")
+    print(f"Rate:       {report.images_per_second:.1f} images/s")
+    if report.missing and not report.scanned:
+        print("No file names matched; check --template and --date",
+              file=sys.stderr)
+
+
+def build_verify_arg_parser(parser=None):
+    """Add the verify command-line options to parser (or a new one)"""
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            prog="qr_scan",
+            description="Scan bulk output and check it against the source CSV")
+    parser.add_argument("input", help="CSV file the codes were generated from")
+    parser.add_argument("source", help="bulk output directory or ZIP archive")
+    parser.add_argument("-t", "--template",
+                        default=qr_bulk.DEFAULT_NAMING_TEMPLATE,
+                        help="naming template used by the bulk run")
+    parser.add_argument("-f", "--format", dest="output_format",
+                        choices=list(qr_bulk.OUTPUT_FORMATS), default="png",
+                        help="output format of the bulk run (only png can "
+                             "be verified)")
+    parser.add_argument("--date", help="{date} of the bulk run as YYYYMMDD "
+                                       "(default: today)")
+    parser.add_argument("--report", metavar="FILE",
+                        help="write mismatches and missing files to a CSV")
+    parser.add_argument("-w", "--workers", type=qr_bulk.positive_int,
+                        default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunksize", type=qr_bulk.positive_int, default=16,
+                        help="images sent to a worker at a time")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="no progress bar")
+    return parser
+
+
+def run_verify_cli(args):
+    """Verify bulk output from parsed arguments and print a summary"""
+    for path in (args.input, args.source):
+        if not os.path.exists(path):
+            print(f"Not found: {path}", file=sys.stderr)
+            return 2
+
+    progress = None
+    if not args.quiet:
+        progress = qr_bulk.ProgressBar(total=qr_bulk.count_rows(args.input))
+
+    try:
+        report = verify_bulk(args.source, qr_bulk.iter_rows(args.input),
+                             naming_template=args.template, date=args.date,
+                             workers=args.workers, chunksize=args.chunksize,
+                             progress=progress,
+                             output_format=args.output_format)
+    except (ValueError, zipfile.BadZipFile) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if progress:
+            progress.finish()
+
+    print_verify_summary(report)
+    if args.report:
+        write_verify_report(report, args.report)
+        print(f"Report:     {args.report}")
+    return 0 if report.ok else 1
+
+
+def main(argv=None):
+    return run_verify_cli(build_verify_arg_parser().parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
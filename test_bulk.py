@@ -0,0 +1,65 @@
+"""Checks of the bulk engine's deduplication: reused renders and hard links.
+
+Run with python -m pytest.
+"""
+import qr_bulk
+import qr_render
+
+
+STYLE = qr_bulk.DEFAULT_BULK_STYLE
+
+
+def test_no_dedup_rerun_does_not_write_through_hard_links(tmp_path):
+    repeated = [{"url": f"https://example.com/same{i % 3}", "name": f"n{i}"}
+                for i in range(12)]
+    distinct = [{"url": f"https://example.com/other{i}", "name": f"n{i}"}
+                for i in range(12)]
+
+    first = qr_bulk.generate_bulk(repeated, tmp_path, workers=1, zip_name=None)
+    assert first.linked == 9
+
+    qr_bulk.generate_bulk(distinct, tmp_path, workers=1, zip_name=None,
+                          dedup=False)
+    for path in sorted(tmp_path.iterdir()):
+        index = int(path.name[1:].split("_")[0])
+        assert path.stat().st_nlink == 1
+        assert path.read_bytes() == qr_render.render_png(
+            distinct[index]["url"], STYLE)
+
+
+def test_duplicate_of_evicted_render_is_rendered_again(monkeypatch):
+    # A one-byte budget evicts each result as soon as the next one lands,
+    # so both duplicates find their first copy gone
+    render_cache = qr_bulk.RenderCache
+    monkeypatch.setattr(qr_bulk, "RenderCache",
+                        lambda: render_cache(max_bytes=1))
+    rendered = []
+    render = qr_bulk._render
+    monkeypatch.setattr(qr_bulk, "_render", lambda *args: rendered.append(
+        args[1]) or render(*args))
+
+    payloads = ["https://example.com/a", "https://example.com/b",
+                "https://example.com/a", "", "https://example.com/b"]
+    rows = [{"url": data} for data in payloads]
+
+    results = list(qr_bulk.render_rows(rows, STYLE, workers=1, chunksize=5))
+
+    assert [duplicate for *_, duplicate in results] == [False, False, True,
+                                                        False, True]
+    # The three distinct payloads, then the two evicted ones again
+    assert rendered == payloads[:2] + [""] + payloads[:2]
+    for data, (_, content, error, _) in zip(payloads, results):
+        if data:
+            assert error is None
+            assert content == qr_render.render_png(data, STYLE)
+        else:
+            assert error == "Row has no data"
+
+
+def test_failed_rows_count_toward_the_cache_budget():
+    cache = qr_bulk.RenderCache(max_bytes=10 * qr_bulk.RenderCache.ENTRY_BYTES)
+    for key in range(1000):
+        cache.claim(key)
+        cache.put(key, (None, "Row has no data"))
+    assert cache.get(0) is None
+    assert cache.get(999) == (None, "Row has no data")
@@ -0,0 +1,94 @@
+"""Checks of the hand-written encoder against the qrcode library.
+
+qr_render plans segments, places bits and scores masks itself; these
+tests rebuild the same symbols with qrcode and compare them module for
+module. Run with python -m pytest.
+"""
+import numpy as np
+import pytest
+import qrcode
+import qrcode.util
+
+import qr_render
+
+
+EC_LEVELS = list(qr_render.ERROR_CORRECTION_LEVELS.values())
+
+PAYLOADS = [
+    "0",
+    "12345678901234567890",
+    "HELLO WORLD",
+    "hello world",
+    "https://example.com/",
+    "https://example.com/products/12345?ref=QR-CODE-2024",
+    "WIFI:T:WPA;S:Office 5G;P:correct horse battery staple;;",
+    "BEGIN:VCARD\nVERSION:3.0\nFN:Jane Doe\nTEL:+1-555-0100\nEND:VCARD",
+    "ORDER 000123456789 SHIP TO 90210",
+    "café crème brûlée 12345678",
+    "日本語のテキスト",
+    "A" * 150 + "1234567890" * 30 + "a" * 80,
+    "0123456789" * 60,
+]
+
+
+def reference_matrix(plan, error_correction, mask_pattern=None):
+    """Build the symbol with qrcode from the same segments and version"""
+    qr = qrcode.QRCode(version=plan.version, error_correction=error_correction,
+                       mask_pattern=mask_pattern, border=0)
+    for mode, chunk in plan.segments:
+        qr.add_data(qrcode.util.QRData(chunk, mode=mode, check_data=False))
+    qr.make(fit=False)
+    return np.array(qr.modules, dtype=bool)
+
+
+@pytest.mark.parametrize("error_correction", EC_LEVELS)
+@pytest.mark.parametrize("data", PAYLOADS)
+def test_encode_matches_qrcode(data, error_correction):
+    encoded = qr_render.encode(data, error_correction)
+    expected = reference_matrix(encoded.plan, error_correction)
+    assert encoded.version == encoded.plan.version
+    assert np.array_equal(encoded.matrix, expected)
+
+
+def test_encode_largest_version_matches_qrcode():
+    ec = qrcode.constants.ERROR_CORRECT_L
+    encoded = qr_render.encode("https://example.com/" * 145, ec)
+    assert encoded.version == 40
+    assert np.array_equal(encoded.matrix, reference_matrix(encoded.plan, ec))
+
+
+@pytest.mark.parametrize("mask_pattern", range(8))
+def test_pinned_mask_matches_qrcode(mask_pattern):
+    data = PAYLOADS[5]
+    ec = qrcode.constants.ERROR_CORRECT_M
+    encoded = qr_render.encode(data, ec, mask_pattern)
+    assert encoded.mask_pattern == mask_pattern
+    assert np.array_equal(encoded.matrix,
+                          reference_matrix(encoded.plan, ec, mask_pattern))
+
+
+@pytest.mark.parametrize("data", PAYLOADS)
+def test_plan_is_no_larger_than_qrcode_fit(data):
+    ec = qrcode.constants.ERROR_CORRECT_H
+    qr = qrcode.QRCode(error_correction=ec)
+    qr.add_data(data)
+    qr.make(fit=True)
+    assert qr_render.plan_encoding(data, ec).version <= qr.version
+
+
+def test_plan_rejects_overflow():
+    with pytest.raises(qrcode.exceptions.DataOverflowError):
+        qr_render.plan_encoding("x" * 3000, qrcode.constants.ERROR_CORRECT_H)
+
+
+@pytest.mark.parametrize("version", [1, 2, 7, 10, 27, 40])
+def test_mask_penalties_match_lost_point(version):
+    template, rows, cols, masks = qr_render.symbol_layout(version)
+    rng = np.random.default_rng(version)
+    unmasked = template.copy()
+    unmasked[rows, cols] = rng.random(len(rows)) < 0.5
+    candidates = unmasked ^ masks
+
+    expected = [qrcode.util.lost_point(candidate.tolist())
+                for candidate in candidates]
+    assert qr_render.mask_penalties(candidates).tolist() == expected